@@ -112,6 +112,7 @@ class CalendarWidget(CustomWidget):
         CustomWidget.__init__(self, *args, **kwargs)
         self.info = info
         self.model = info.model
+        self.expansion = info.model.cursor()
         info.connect("date-changed", self.info_changed)
         info.connect("selection-recurrence-changed", self.info_changed)
         info.connect("selected-changed", self.info_changed)
@@ -184,8 +185,10 @@ class CalendarInfo(gobject.GObject):
     def __init__(self, model, *args, **kwargs):
         gobject.GObject.__init__(self, *args, **kwargs)
         self.model = model
-        self.model.set_changed_cb(self.model_changed)
+        # deliver model changes once per main loop iteration
+        self.model.changes.idle = gobject.idle_add
+        self.model.changes.connect(self.model_changed)
 
-    def model_changed(self):
+    def model_changed(self, changes):
         self.emit("model-changed")
 
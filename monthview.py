@@ -75,7 +75,7 @@ class MonthView(CalendarWidget):
 
     def get_events_by_date(self):
         events = {}
-        for event, occurrence in self.info.model.timedOccurrences(*self.dates_visible()):
+        for event, occurrence in self.expansion.timedOccurrences(*self.dates_visible()):
             if not (occurrence.date in events):
                 events[occurrence.date] = []
             events[occurrence.date].append(event)
@@ -470,9 +470,14 @@ def p_datetimeset_for_weeks(t):
     t[0] = ast.Until(t[1], datetime.date.today() +
                      datetime.timedelta(days=t[3] * 7))
 
+# the count has to start somewhere, so recurrences without a first
+# date start counting today
 def p_datetimeset_repeating(t):
     '''datetimeset : datetimeset REPEATING count'''
-    t[0] = ast.For(t[1], t[3])
+    child = t[1]
+    if child.bounds()[0] == datetime.date.min:
+        child = ast.From(child, datetime.date.today())
+    t[0] = ast.For(child, t[3])
 
 def p_datetimeset_group(t):
     '''datetimeset : LPAREN datetimeset RPAREN'''
@@ -578,6 +583,9 @@ if __name__ == '__main__':
     test_parse("every 2 days repeating twice",
                ast.For(ast.Daily(datetime.date.today(), 2), 3))
 
+    test_parse("every wed repeating 3 times",
+               ast.For(ast.From(ast.Weekly(2), datetime.date.today()), 3))
+
     test_parse("every 2 days for 3 weeks",
                ast.Until(ast.Daily(datetime.date.today(), 2),
                          datetime.date.today() + datetime.timedelta(days=21)))
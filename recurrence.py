@@ -20,6 +20,48 @@
 # Boston, MA 02111-1307, USA.
 
 import datetime
+import calendar
+import heapq
+import bisect
+import weakref
+import fractions
+import array
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+one_day = datetime.timedelta(days=1)
+epsilon = datetime.timedelta(microseconds=1)
+
+# how far to search for a next or previous occurrence before giving
+# up: one full cycle of the gregorian calendar.
+search_horizon = 146097
+
+def lcm(a, b):
+    if a is None or b is None:
+        return None
+    return a * b / fractions.gcd(a, b)
+
+def clampedDate(ordinal):
+    ordinal = min(max(ordinal, 1), datetime.date.max.toordinal())
+    return datetime.date.fromordinal(ordinal)
+
+# unbounded ends of a span are left at date.min and date.max
+def shiftBound(date, days):
+    if date in (datetime.date.min, datetime.date.max):
+        return date
+    return clampedDate(date.toordinal() + days)
+
+def shiftDatetime(value, delta):
+    try:
+        return value + delta
+    except OverflowError:
+        if delta > datetime.timedelta():
+            return datetime.datetime.max
+        return datetime.datetime.min
 
 def dateRange(start, end):
     dt = datetime.timedelta(days=1)
@@ -28,6 +70,176 @@ def dateRange(start, end):
         yield cur
         cur += dt
 
+def daysInMonth(year, month):
+    return calendar.monthrange(year, month)[1]
+
+class CalendarBlock(object):
+
+    # The calendar fields of a run of consecutive day ordinals, each
+    # in a compact array indexed by the offset from the first.
+
+    __slots__ = ("year", "month", "day", "weekday", "nth", "nth_last",
+                 "days_in_month")
+
+    def __init__(self, first, length):
+        for name in self.__slots__:
+            setattr(self, name, array.array("H" if name == "year" else "B"))
+        date = datetime.date.fromordinal(first)
+        year, month, day = date.year, date.month, date.day
+        weekday = date.weekday()
+        last_day = daysInMonth(year, month)
+        for i in xrange(length):
+            self.year.append(year)
+            self.month.append(month)
+            self.day.append(day)
+            self.weekday.append(weekday)
+            self.nth.append((day - 1) / 7 + 1)
+            self.nth_last.append((last_day - day) / 7 + 1)
+            self.days_in_month.append(last_day)
+            weekday = (weekday + 1) % 7
+            day += 1
+            if day > last_day:
+                day = 1
+                month += 1
+                if month > 12:
+                    month = 1
+                    year += 1
+                if year > datetime.MAXYEAR:
+                    break
+                last_day = daysInMonth(year, month)
+
+class CalendarTable(object):
+
+    # Calendar fields by day ordinal, filled in a block at a time as
+    # dates are looked up, so that date predicates don't need to build
+    # date objects.
+
+    block_bits = 10
+
+    def __init__(self):
+        self.blocks = {}
+        self.first_weekday = None
+        self.month_days = None
+
+    # returns the block holding the given ordinal, and its index there
+    def lookup(self, ordinal):
+        key = ordinal >> self.block_bits
+        block = self.blocks.get(key)
+        if block is None:
+            first = max(key << self.block_bits, 1)
+            length = ((key + 1) << self.block_bits) - first
+            block = self.blocks[key] = CalendarBlock(first, length)
+        return block, ordinal - (key << self.block_bits) - (key == 0)
+
+    # returns the weekday of the first of a month, and the number of
+    # days in it. The calendar repeats every 400 years, so one cycle of
+    # months covers every year.
+    def monthFields(self, year, month):
+        if self.month_days is None:
+            self.fillMonths()
+        i = (year - 1) % 400 * 12 + month - 1
+        return self.first_weekday[i], self.month_days[i]
+
+    def fillMonths(self):
+        self.first_weekday = array.array("B")
+        self.month_days = array.array("B")
+        # 1/1/0001 was a monday
+        weekday = 0
+        for year in xrange(1, 401):
+            for month in xrange(1, 13):
+                days = daysInMonth(year, month)
+                self.first_weekday.append(weekday)
+                self.month_days.append(days)
+                weekday = (weekday + days) % 7
+
+calendarTable = CalendarTable()
+
+# A recurrence compiled into closures: test(ordinal) tells whether it
+# occurs on a day ordinal (or is None if it can't test dates), and
+# expand(start, end) works like timedOccurrences.
+Compiled = collections.namedtuple("Compiled", "test expand")
+
+# Bitmaps are plain integers used as bit sets, where bit i is set if a
+# recurrence occurs on the ith day of a window.
+
+def windowLength(start, end):
+    return end.toordinal() - start.toordinal() + 1
+
+def rangeBitmap(first, last):
+    first = max(first, 0)
+    if last < first:
+        return 0
+    return ((1 << (last - first + 1)) - 1) << first
+
+def repeatBitmap(pattern, period, length):
+    if length <= 0:
+        return 0
+    unit = format(pattern, "0%db" % period)
+    return int(unit * (length / period + 1), 2) & ((1 << length) - 1)
+
+def bitmapDates(bitmap, start):
+    first = start.toordinal()
+    bits = bin(bitmap)[:1:-1]
+    i = bits.find("1")
+    while i >= 0:
+        yield datetime.date.fromordinal(first + i)
+        i = bits.find("1", i + 1)
+
+class DateFields(object):
+
+    # The calendar fields of an array of day ordinals, computed in bulk
+    # with numpy the first time they're asked for.
+
+    month_lengths = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+    def __init__(self, ordinals):
+        self.ordinals = ordinals
+        self.ymd = None
+
+    def civil(self):
+        if self.ymd is None:
+            # shift to days since 3/1/0000, so that leap days fall at
+            # the end of each year and every era is 400 years long.
+            z = self.ordinals + 305
+            era = z // 146097
+            doe = z - era * 146097
+            yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+            doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+            mp = (5 * doy + 2) // 153
+            day = doy - (153 * mp + 2) // 5 + 1
+            month = numpy.where(mp < 10, mp + 3, mp - 9)
+            year = yoe + era * 400 + (month <= 2)
+            self.ymd = (year, month, day)
+        return self.ymd
+
+    @property
+    def year(self):
+        return self.civil()[0]
+
+    @property
+    def month(self):
+        return self.civil()[1]
+
+    @property
+    def day(self):
+        return self.civil()[2]
+
+    @property
+    def weekday(self):
+        return (self.ordinals + 6) % 7
+
+    @property
+    def days_in_month(self):
+        year = self.year
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        return (numpy.array(self.month_lengths)[self.month] +
+                ((self.month == 2) & leap))
+
+def weekdayMask(weekdays, fields):
+    table = numpy.zeros(7, dtype=bool)
+    table[list(weekdays)] = True
+    return table[fields.weekday]
+
 def fromDateTimes(start, end):
     return Period(DateSet(start.date()), start.time(), end.time())
 
@@ -41,6 +253,14 @@ def dateToStr(date):
 def timeToStr(time):
     return "%d:%02d" % (time.hour, time.minute)
 
+def durationToStr(delta):
+    hours, minutes = divmod(delta.days * 24 * 60 + delta.seconds / 60, 60)
+    if hours and minutes:
+        return "%d hours %d minutes" % (hours, minutes)
+    if hours:
+        return "%d hours" % hours
+    return "%d minutes" % minutes
+
 def timeDeltaToStr(delta):
     ret = ""
     if delta.days != 0:
@@ -57,40 +277,66 @@ def timeDeltaToStr(delta):
 
 class Occurrence(object):
 
+    # Lots of these get created, so only the day ordinal and the start
+    # and end minute (counted from midnight of that day) are stored;
+    # the dates and datetimes are built when asked for.
+
+    __slots__ = ("ordinal", "creator", "day_ordinal", "start_minute",
+                 "end_minute", "all_day")
+
     def __init__(self, ordinal, creator, date, start=None, end=None):
+        self.ordinal = ordinal
+        self.creator = creator
+        self.day_ordinal = date.toordinal()
         if start and end:
-            self.start = datetime.datetime(
-                date.year,
-                date.month,
-                date.day,
-                start.hour,
-                start.minute)
-            self.end = datetime.datetime(
-                date.year,
-                date.month,
-                date.day,
-                end.hour,
-                end.minute)
+            self.start_minute = start.hour * 60 + start.minute
+            self.end_minute = end.hour * 60 + end.minute
             self.all_day = False
         else:
-            self.start = datetime.datetime(
-                date.year,
-                date.month,
-                date.day,
-                0,
-                0)
-            self.end = datetime.datetime(
-                date.year,
-                date.month,
-                date.day,
-                23,
-                59)
+            self.start_minute = 0
+            self.end_minute = 23 * 60 + 59
             self.all_day = True
-        self.duration = self.end - self.start
-        self.date = date
-        self.id = (self.start, self.end)
-        self.ordinal = ordinal
-        self.creator = creator
+
+    @classmethod
+    def fromMinutes(cls, ordinal, creator, day_ordinal, start_minute,
+                    end_minute, all_day=False):
+        ret = cls.__new__(cls)
+        ret.ordinal = ordinal
+        ret.creator = creator
+        ret.day_ordinal = day_ordinal + start_minute / 1440
+        ret.start_minute = start_minute % 1440
+        ret.end_minute = end_minute - (start_minute - ret.start_minute)
+        ret.all_day = all_day
+        return ret
+
+    @property
+    def date(self):
+        return datetime.date.fromordinal(self.day_ordinal)
+
+    @property
+    def start(self):
+        return (datetime.datetime.fromordinal(self.day_ordinal) +
+                datetime.timedelta(minutes=self.start_minute))
+
+    @property
+    def end(self):
+        return (datetime.datetime.fromordinal(self.day_ordinal) +
+                datetime.timedelta(minutes=self.end_minute))
+
+    @property
+    def duration(self):
+        return datetime.timedelta(minutes=self.end_minute - self.start_minute)
+
+    @property
+    def id(self):
+        return (self.start, self.end)
+
+    # the start and end in minutes since 1/1/0001, which orders
+    # occurrences the same way as their ids
+    @property
+    def key(self):
+        base = self.day_ordinal * 1440
+        return (base + self.start_minute, base + self.end_minute)
 
     @property
     def year(self):
@@ -106,51 +352,84 @@ class Occurrence(object):
 
     @property
     def hour(self):
-        return self.date.hour
+        return self.start_minute / 60
 
     @property
     def minute(self):
-        return self.date.minute
+        return self.start_minute % 60
 
     def __eq__(self, other):
-        if other == None:
+        if other is None:
             return False
-        return self.id == other.id
+        return self.key == other.key
 
     def __lt__(self, other):
-        if other == None:
+        if other is None:
             return False
-        return self.id < other.id
+        return self.key < other.key
 
     def __gt__(self, other):
-        if other == None:
+        if other is None:
             return False
-        return self.id > other.id
+        return self.key > other.key
     
     def __hash__(self):
-        return hash(self.id)
+        return hash(self.key)
 
     def __add__(self, delta):
-        return Occurrence(self.ordinal, self.creator, self.date + delta,
-                          self.start + delta, self.end + delta)
+        shift = delta.days * 1440 + delta.seconds / 60
+        return Occurrence.fromMinutes(self.ordinal, self.creator, self.day_ordinal,
+                                      self.start_minute + shift,
+                                      self.end_minute + shift,
+                                      self.all_day and not (shift % 1440))
 
     def clone(self, ordinal=None, creator=None, date=None, start=None, end=None):
-        return Occurrence(ordinal if ordinal else self.ordinal,
-                          creator if creator else self.creator,
-                          date if date else self.date,
-                          start if start else self.start,
-                          end if end else self.end)
+        return Occurrence.fromMinutes(
+            ordinal if ordinal else self.ordinal,
+            creator if creator else self.creator,
+            date.toordinal() if date else self.day_ordinal,
+            start.hour * 60 + start.minute if start else self.start_minute,
+            end.hour * 60 + end.minute if end else self.end_minute)
+
+class Interned(type):
+
+    # Constructing a node returns the existing node with the same type
+    # and children, if there is one. Since children are themselves
+    # interned, structurally equal trees are the same object, and nodes
+    # compare and hash by identity.
+
+    table = weakref.WeakValueDictionary()
+
+    def __call__(cls, *args):
+        node = type.__call__(cls, *args)
+        return cls.table.setdefault((cls, node.children), node)
 
 class Node(object):
 
+    # nodes are shared between every tree that contains them, so they
+    # must never be modified after construction. Use replace() to
+    # build a changed copy of a tree.
+    __metaclass__ = Interned
+
+    # cached by compile(). Caches like this one and MonthSlots'
+    # cycle_counts are the only attributes set after construction:
+    # they're filled in lazily from the node's children and don't
+    # change what the node means, so sharing them is safe.
+    compiled = None
+
     def __init__(self, *children):
         self.children = children
 
-    def __eq__(self, other):
-        return (type(self) == type(other)) and (self.children == other.children)
-
-    def __hash__(self):
-        return hash((type(self), self.children))
+    # returns this tree with every occurrence of the node old replaced
+    # by new
+    def replace(self, old, new):
+        if self is old:
+            return new
+        children = tuple(c.replace(old, new) if isinstance(c, Node) else c
+                         for c in self.children)
+        if all(a is b for a, b in zip(children, self.children)):
+            return self
+        return type(self)(*children)
 
     def __str__(self):
         return self.__class__.__name__ + "(" + \
@@ -163,28 +442,268 @@ class Node(object):
         raise NotImplemented
 
     def occursOnDate(self, date):
+        return self.occursOnOrdinal(date.toordinal())
+
+    def occursOnOrdinal(self, ordinal):
         raise NotImplemented
 
     def ordinal(self, date):
         raise NotImplemented
 
-    def timedOccurrences(self, start, end):
+    # returns this recurrence compiled into closures with its constants
+    # bound, compiling it the first time.
+    def compile(self):
+        if self.compiled is None:
+            self.compiled = Compiled(self.compileTest(),
+                                     self.compileExpansion())
+        return self.compiled
+
+    def compileTest(self):
+        if not self.testsDates():
+            return None
+        return self.occursOnOrdinal
+
+    def compileExpansion(self):
+        return self.timedOccurrences
+
+    # whether occursOnDate() is implemented for this recurrence
+    def testsDates(self):
+        return True
+
+    # yields an (ordinal, date) pair for each date between start and
+    # end on which this recurrence occurs. Subclasses which can
+    # compute their dates directly should override this; the default
+    # tests every date in the range.
+    def occurrenceDates(self, start, end):
         count = None
-        for date in dateRange(start, end):
-            if self.occursOnDate(date):
+        test = self.compile().test
+        for ordinal in xrange(start.toordinal(), end.toordinal() + 1):
+            if test(ordinal):
+                date = datetime.date.fromordinal(ordinal)
                 if count is None:
                     count = self.ordinal(date)
-                yield Occurrence(count, self, date)
+                yield count, date
                 count += 1
 
+    # span, if given, is a (creator, start minute, end minute) triple
+    # from an enclosing Period, which is used to build timed
+    # occurrences directly instead of all-day ones.
+    def timedOccurrences(self, start, end, span=None):
+        if span is None:
+            for count, date in self.occurrenceDates(start, end):
+                yield Occurrence(count, self, date)
+        else:
+            creator, first, last = span
+            for count, date in self.occurrenceDates(start, end):
+                yield Occurrence.fromMinutes(count, creator, date.toordinal(),
+                                             first, last)
+
+    def countOccurrences(self, start, end):
+        count = 0
+        for occurrence in self.timedOccurrences(start, end):
+            count += 1
+        return count
+
+    # whether this recurrence occurs at most once on any date
+    def onePerDay(self):
+        return True
+
+    # returns the (earliest, latest) dates on which this recurrence
+    # could occur. The span may be wider than the real one, but never
+    # narrower; if earliest is after latest it never occurs.
+    def bounds(self):
+        return datetime.date.min, datetime.date.max
+
+    # returns the number of days after which this recurrence repeats,
+    # or None if it doesn't. Repetition only holds between the steady
+    # bounds, where every part of the recurrence has started and none
+    # has ended.
+    def period(self):
+        return None
+
+    def steadyBounds(self):
+        earliest, latest = self.bounds()
+        for child in self.children:
+            if isinstance(child, Node):
+                first, last = child.steadyBounds()
+                earliest = max(earliest, first)
+                latest = min(latest, last)
+        return earliest, latest
+
+    # returns how far ordinals move over one period, days long,
+    # starting on date, which is within the steady bounds. It's the
+    # same for every period, so tiling only has to count it once.
+    def ordinalStep(self, days, date):
+        return self.countOccurrences(date, date + datetime.timedelta(days - 1))
+
+    # returns the ordinal of the occurrence count periods after the
+    # one with the given ordinal, given the step for one period
+    def advanceOrdinal(self, ordinal, count, step):
+        return ordinal + count * step
+
+    # the same as timedOccurrences, but periodic recurrences are
+    # expanded over one period and copied across the rest of the window
+    def tiledOccurrences(self, start, end):
+        period = self.period()
+        if period is None:
+            return list(self.compile().expand(start, end))
+        expand = self.compile().expand
+        earliest, latest = self.steadyBounds()
+        first = max(start, earliest)
+        last = min(end, latest)
+        if first > last or (last - first).days + 1 < 2 * period:
+            return list(expand(start, end))
+        if start < first:
+            ret = list(expand(start, first - one_day))
+        else:
+            ret = []
+        cycle = list(expand(
+            first, first + datetime.timedelta(period - 1)))
+        ret.extend(cycle)
+        step = self.ordinalStep(period, first)
+        advance = self.advanceOrdinal
+        make = Occurrence.fromMinutes
+        last_ordinal = last.toordinal()
+        count = 1
+        while cycle:
+            days = count * period
+            for occurrence in cycle:
+                day = occurrence.day_ordinal + days
+                if day > last_ordinal:
+                    cycle = None
+                    break
+                ret.append(make(advance(occurrence.ordinal, count, step),
+                                occurrence.creator, day,
+                                occurrence.start_minute,
+                                occurrence.end_minute, occurrence.all_day))
+            count += 1
+        if last < end:
+            ret.extend(expand(last + one_day, end))
+        return ret
+
+    # nextDate and previousDate return the first date on or after (or
+    # the last date on or before) the given date on which this
+    # recurrence occurs, or None. By default we scan ever larger
+    # windows out to the search horizon.
+    def nextDate(self, date):
+        first = date.toordinal()
+        size = 32
+        while first <= date.toordinal() + search_horizon:
+            start = clampedDate(first)
+            for occurrence in self.timedOccurrences(start, clampedDate(first + size - 1)):
+                if occurrence.date >= start:
+                    return occurrence.date
+            if first + size > datetime.date.max.toordinal():
+                break
+            first += size
+            size *= 2
+        return None
+
+    def previousDate(self, date):
+        last = date.toordinal()
+        size = 32
+        while last >= date.toordinal() - search_horizon:
+            end = clampedDate(last)
+            found = None
+            for occurrence in self.timedOccurrences(clampedDate(last - size + 1), end):
+                if occurrence.date <= end:
+                    found = occurrence.date
+            if found:
+                return found
+            if last - size < 1:
+                break
+            last -= size
+            size *= 2
+        return None
+
+    # returns the first occurrence starting after the given datetime,
+    # or None
+    def nextOccurrence(self, after):
+        date = self.nextDate(after.date())
+        while date is not None:
+            for occurrence in self.timedOccurrences(date, date):
+                if occurrence.start > after:
+                    return occurrence
+            if date == datetime.date.max:
+                break
+            date = self.nextDate(date + one_day)
+        return None
+
+    # returns the last occurrence starting before the given datetime,
+    # or None
+    def previousOccurrence(self, before):
+        date = self.previousDate(before.date())
+        while date is not None:
+            for occurrence in reversed(list(self.timedOccurrences(date, date))):
+                if occurrence.start < before:
+                    return occurrence
+            if date == datetime.date.min:
+                break
+            date = self.previousDate(date - one_day)
+        return None
+
+    # tests an array of day ordinals at once, returning a boolean
+    # array (or a list, if numpy isn't available). occursOnOrdinal
+    # remains the reference for what these should return.
+    def occursOnOrdinals(self, ordinals):
+        if numpy is None:
+            if self.testsDates():
+                test = self.compile().test
+                return [test(o) for o in ordinals]
+            return list(self.bitmapMask(ordinals))
+        ordinals = numpy.asarray(ordinals, dtype=numpy.int64)
+        return self.ordinalMask(ordinals, DateFields(ordinals))
+
+    def ordinalMask(self, ordinals, fields):
+        if self.testsDates():
+            test = self.compile().test
+            return numpy.array([test(int(o)) for o in ordinals], dtype=bool)
+        return self.bitmapMask(ordinals)
+
+    # answers from the bitmap spanning the given ordinals, for
+    # recurrences which can't test dates directly
+    def bitmapMask(self, ordinals):
+        if not len(ordinals):
+            return numpy.zeros(0, dtype=bool) if numpy else []
+        first = min(ordinals)
+        last = max(ordinals)
+        bits = bin(self.toBitmap(datetime.date.fromordinal(int(first)),
+                                 datetime.date.fromordinal(int(last))))[:1:-1]
+        bits = bits.ljust(last - first + 1, "0")
+        if numpy is None:
+            return [bits[o - first] == "1" for o in ordinals]
+        flags = numpy.frombuffer(bits, dtype=numpy.uint8) == ord("1")
+        return flags[ordinals - first]
+
+    def toBitmap(self, start, end):
+        first = start.toordinal()
+        length = windowLength(start, end)
+        bitmap = 0
+        for occurrence in self.timedOccurrences(start, end):
+            i = occurrence.day_ordinal - first
+            if 0 <= i < length:
+                bitmap |= 1 << i
+        return bitmap
+
     def toAllday(self):
         return self
 
+    # returns an equivalent recurrence in canonical form: nested nodes
+    # are merged or folded where that makes them cheaper to expand.
+    # The result has the same occurrence times, but coincident
+    # occurrences may be merged and ordinals may be renumbered.
+    def simplify(self):
+        return self
+
+def isEmpty(node):
+    return isinstance(node, DateSet) and not node.children
+
 class DateSet(Node):
 
     def __init__(self, *children):
-        Node.__init__(self, *sorted(children))
         self.dates = set(children)
+        self.ordinals = set(d.toordinal() for d in self.dates)
+        Node.__init__(self, *sorted(self.dates))
 
     def __add__(self, delta):
         assert not (datetime is None)
@@ -196,8 +715,45 @@ class DateSet(Node):
     def ordinal(self, date):
         return self.children.index(date)
 
-    def occursOnDate(self, date):
-        return date in self.dates
+    def occursOnOrdinal(self, ordinal):
+        return ordinal in self.ordinals
+
+    def compileTest(self):
+        return self.ordinals.__contains__
+
+    def occurrenceDates(self, start, end):
+        first = bisect.bisect_left(self.children, start)
+        last = bisect.bisect_right(self.children, end)
+        for i in xrange(first, last):
+            yield i, self.children[i]
+
+    def ordinalMask(self, ordinals, fields):
+        return numpy.in1d(ordinals, [d.toordinal() for d in self.dates])
+
+    def countOccurrences(self, start, end):
+        return max(0, bisect.bisect_right(self.children, end) -
+                   bisect.bisect_left(self.children, start))
+
+    def bounds(self):
+        if not self.children:
+            return datetime.date.max, datetime.date.min
+        return self.children[0], self.children[-1]
+
+    def nextDate(self, date):
+        i = bisect.bisect_left(self.children, date)
+        return self.children[i] if i < len(self.children) else None
+
+    def previousDate(self, date):
+        i = bisect.bisect_right(self.children, date)
+        return self.children[i - 1] if i else None
+
+    def toBitmap(self, start, end):
+        first = start.toordinal()
+        bitmap = 0
+        for date in self.dates:
+            if start <= date <= end:
+                bitmap |= 1 << (date.toordinal() - first)
+        return bitmap
 
 class Daily(Node):
 
@@ -217,10 +773,65 @@ class Daily(Node):
     def ordinal(self, date):
         return (date.toordinal() - self.start) / self.step
 
-    def occursOnDate(self, date):
-        ord = date.toordinal()
+    def countBefore(self, ord):
+        if ord <= self.start:
+            return 0
+        return (ord - self.start - 1) / self.step + 1
+
+    def countOccurrences(self, start, end):
+        return max(0, self.countBefore(end.toordinal() + 1) -
+                   self.countBefore(start.toordinal()))
+
+    def bounds(self):
+        return self.children[0], datetime.date.max
+
+    def period(self):
+        return self.step
+
+    def occursOnOrdinal(self, ord):
         return ord >= self.start and (((ord - self.start) % self.step) == 0)
 
+    def compileTest(self):
+        start, step = self.start, self.step
+        if step == 1:
+            return lambda ord: ord >= start
+        return lambda ord: ord >= start and (ord - start) % step == 0
+
+    def occurrenceDates(self, start, end):
+        first = max(start.toordinal(), self.start)
+        last = end.toordinal()
+        # round up to the first ordinal in phase with our start date
+        count = (first - self.start + self.step - 1) / self.step
+        ord = self.start + count * self.step
+        while ord <= last:
+            yield count, datetime.date.fromordinal(ord)
+            count += 1
+            ord += self.step
+
+    def ordinalMask(self, ordinals, fields):
+        return (ordinals >= self.start) & ((ordinals - self.start) % self.step == 0)
+
+    def nextDate(self, date):
+        ord = max(date.toordinal(), self.start)
+        ord += (self.start - ord) % self.step
+        if ord > datetime.date.max.toordinal():
+            return None
+        return datetime.date.fromordinal(ord)
+
+    def previousDate(self, date):
+        ord = date.toordinal()
+        if ord < self.start:
+            return None
+        return datetime.date.fromordinal(ord - (ord - self.start) % self.step)
+
+    def toBitmap(self, start, end):
+        first = start.toordinal()
+        begin = max(first, self.start)
+        begin += (self.start - begin) % self.step
+        begin -= first
+        return repeatBitmap(1, self.step,
+                            windowLength(start, end) - begin) << begin
+
 daynames = [
     "monday",
     "tuesday",
@@ -234,24 +845,94 @@ daynames = [
 class Weekly(Node):
 
     def __init__(self, *children):
-        Node.__init__(self, *children)
+        Node.__init__(self, *sorted(set(children)))
         self.days = set(children)
+        # gaps[w] is the number of days from weekday w to the next
+        # weekday in the set (0 if w itself is in the set), back_gaps
+        # the same looking backwards, and
+        # before[w] is the number of weekdays in the set less than w.
+        self.gaps = [min((d - w) % 7 for d in self.days) if self.days else None
+                     for w in xrange(7)]
+        self.back_gaps = [min((w - d) % 7 for d in self.days) if self.days else None
+                          for w in xrange(7)]
+        self.before = [len([d for d in self.days if d < w]) for w in xrange(7)]
 
     def __add__(self, delta):
         return Weekly(*((c + delta.days) % 7 for c in self.days))
 
+    def simplify(self):
+        if not self.days:
+            return DateSet()
+        return self
+
+    def period(self):
+        return 7
+
     def toEnglish(self):
         return "every " + ", ".join((daynames[d] for d in self.days))
 
+    # ordinals count occurrences since 1/1/0001, which was a monday
     def ordinal(self, date):
-        days = [1 if (d in self.days) else 0 for d in range(7)]
-        ordinal = date.toordinal()
-        ordinals_per_week = len(days)
-        base = ((ordinal / 7) - 1) * ordinals_per_week
-        return base + sum(days[date.weekday():])
-
-    def occursOnDate(self, date):
-        return date.weekday() in self.days
+        return self.countBefore(date.toordinal())
+
+    def countBefore(self, ord):
+        ord -= 1
+        return (ord / 7) * len(self.days) + self.before[ord % 7]
+
+    def countOccurrences(self, start, end):
+        if not self.days:
+            return 0
+        return max(0, self.countBefore(end.toordinal() + 1) -
+                   self.countBefore(start.toordinal()))
+
+    def occursOnOrdinal(self, ordinal):
+        return (ordinal + 6) % 7 in self.days
+
+    def compileTest(self):
+        # indexed by ordinal % 7, which is 0 on sundays
+        flags = tuple((w + 6) % 7 in self.days for w in xrange(7))
+        return lambda ordinal: flags[ordinal % 7]
+
+    def occurrenceDates(self, start, end):
+        if not self.days:
+            return
+        ord = start.toordinal()
+        ord += self.gaps[(ord - 1) % 7]
+        last = end.toordinal()
+        count = self.countBefore(ord)
+        while ord <= last:
+            yield count, datetime.date.fromordinal(ord)
+            count += 1
+            ord += 1 + self.gaps[ord % 7]
+
+    def ordinalMask(self, ordinals, fields):
+        return weekdayMask(self.days, fields)
+
+    def nextDate(self, date):
+        if not self.days:
+            return None
+        ord = date.toordinal()
+        ord += self.gaps[(ord - 1) % 7]
+        if ord > datetime.date.max.toordinal():
+            return None
+        return datetime.date.fromordinal(ord)
+
+    def previousDate(self, date):
+        if not self.days:
+            return None
+        ord = date.toordinal()
+        ord -= self.back_gaps[(ord - 1) % 7]
+        if ord < 1:
+            return None
+        return datetime.date.fromordinal(ord)
+
+    def toBitmap(self, start, end):
+        weekday = start.weekday()
+        pattern = 0
+        for i in xrange(7):
+            if (weekday + i) % 7 in self.days:
+                pattern |= 1 << i
+        return repeatBitmap(pattern, 7, windowLength(start, end))
 
 monthnames = [
     "january",
@@ -262,12 +943,129 @@ monthnames = [
     "june",
     "july",
     "august",
+    "september",
     "october",
     "november",
     "december"
     ]
 
-class Monthly(Node):
+class MonthSlots(Node):
+
+    # Base class for recurrences which occur on fixed days of each
+    # month. A "slot" is a month in which the recurrence may occur:
+    # every month since 1/0001, or every year if a month is given.
+    # Subclasses provide daysInSlot(). The calendar repeats every 400
+    # years, so when the number of days per slot varies, we count
+    # them once over a whole cycle.
+
+    cycle_years = 400
+    cycle_counts = None
+
+    def slot(self, year, month):
+        if self.month:
+            return year - 1
+        return (year - 1) * 12 + month - 1
+
+    def slotMonth(self, slot):
+        if self.month:
+            return slot + 1, self.month
+        return slot / 12 + 1, slot % 12 + 1
+
+    def daysInSlot(self, slot):
+        raise NotImplemented
+
+    # returns the number of days in every slot, or None if it varies
+    def daysPerSlot(self):
+        return None
+
+    def countBeforeSlot(self, slot):
+        per_slot = self.daysPerSlot()
+        if per_slot is not None:
+            return slot * per_slot
+
+        if self.cycle_counts is None:
+            self.cycle_counts = [0]
+            for s in xrange(self.slot(self.cycle_years + 1, 1)):
+                self.cycle_counts.append(self.cycle_counts[-1] +
+                                         len(self.daysInSlot(s)))
+        cycles, slot = divmod(slot, len(self.cycle_counts) - 1)
+        return cycles * self.cycle_counts[-1] + self.cycle_counts[slot]
+
+    def ordinal(self, date):
+        slot = self.slot(date.year, date.month)
+        if self.month and date.month != self.month:
+            before = self.countBeforeSlot(slot)
+            if date.month > self.month:
+                before += len(self.daysInSlot(slot))
+            return before
+        return self.countBeforeSlot(slot) + \
+            len([d for d in self.daysInSlot(slot) if d < date.day])
+
+    def countBefore(self, ord):
+        return self.ordinal(datetime.date.fromordinal(ord))
+
+    def countOccurrences(self, start, end):
+        if end == datetime.date.max:
+            last = self.countBefore(end.toordinal()) + int(self.occursOnDate(end))
+        else:
+            last = self.countBefore(end.toordinal() + 1)
+        return max(0, last - self.countBefore(start.toordinal()))
+
+    def occursEver(self):
+        return self.countBeforeSlot(self.slot(self.cycle_years + 1, 1)) > 0
+
+    # the gregorian calendar repeats every 400 years
+    def period(self):
+        return datetime.date(self.cycle_years + 1, 1, 1).toordinal() - 1
+
+    def nextDate(self, date):
+        if not self.occursEver():
+            return None
+        slot = self.slot(date.year, date.month)
+        while True:
+            year, month = self.slotMonth(slot)
+            if year > datetime.MAXYEAR:
+                return None
+            for day in self.daysInSlot(slot):
+                if datetime.date(year, month, day) >= date:
+                    return datetime.date(year, month, day)
+            slot += 1
+
+    def previousDate(self, date):
+        if not self.occursEver():
+            return None
+        slot = self.slot(date.year, date.month)
+        while slot >= 0:
+            year, month = self.slotMonth(slot)
+            for day in reversed(self.daysInSlot(slot)):
+                if datetime.date(year, month, day) <= date:
+                    return datetime.date(year, month, day)
+            slot -= 1
+        return None
+
+    def occurrenceDates(self, start, end):
+        slot = self.slot(start.year, start.month)
+        if self.month and start.month > self.month:
+            slot += 1
+        last = self.slot(end.year, end.month)
+        if self.month and end.month < self.month:
+            last -= 1
+        count = None
+        while slot <= last:
+            year, month = self.slotMonth(slot)
+            for day in self.daysInSlot(slot):
+                date = datetime.date(year, month, day)
+                if start <= date <= end:
+                    if count is None:
+                        count = self.ordinal(date)
+                    yield count, date
+                    count += 1
+            slot += 1
+
+class Monthly(MonthSlots):
+
+    # Months which don't have the given day (for example the 31st of
+    # each month) are skipped, rather than clamped to the last day.
 
     def __init__(self, month, day):
         Node.__init__(self, month, day)
@@ -281,21 +1079,44 @@ class Monthly(Node):
         if not self.month:
             return "%d of each month" % self.day
         else:
-            return "%d of each %s" % (self.day, monthnames[self.month])
+            return "%d of each %s" % (self.day, monthnames[self.month - 1])
 
-    def ordinal(self, date):
-        if self.month:
-            return date.year
+    def daysInSlot(self, slot):
+        first, last = calendarTable.monthFields(*self.slotMonth(slot))
+        if 1 <= self.day <= last:
+            return [self.day]
+        return []
 
-        # note: no handling of leap years, or when day > 28
-        return ((date.year - 1) * 12 + (date.month - 2) +
-                (1 if date.day >= self.day else 0))
+    def daysPerSlot(self):
+        if 1 <= self.day <= 28:
+            return 1
+        return None
 
-    def occursOnDate(self, date):
+    def occursOnOrdinal(self, ordinal):
+        block, i = calendarTable.lookup(ordinal)
         if not self.month:
-            return date.day == self.day
+            return block.day[i] == self.day
+        else:
+            return (block.day[i] == self.day) and (block.month[i] == self.month)
+
+    def compileTest(self):
+        lookup = calendarTable.lookup
+        day, month = self.day, self.month
+        if not month:
+            def test(ordinal):
+                block, i = lookup(ordinal)
+                return block.day[i] == day
         else:
-            return (date.day == self.day) and (date.month == self.month)
+            def test(ordinal):
+                block, i = lookup(ordinal)
+                return block.day[i] == day and block.month[i] == month
+        return test
+
+    def ordinalMask(self, ordinals, fields):
+        mask = fields.day == self.day
+        if self.month:
+            mask &= fields.month == self.month
+        return mask
 
 def toOrdinal(n):
     s = str(n)
@@ -309,8 +1130,8 @@ class Offset(Node):
 
     def __init__(self, child, offset):
         if isinstance(child, Offset):
-            child = child.child
             offset = child.offset + offset
+            child = child.child
         Node.__init__(self, child, offset)
         self.child = child
         self.offset = offset
@@ -331,13 +1152,109 @@ class Offset(Node):
     def toAllday(self):
         return Offset(self.child.toAllday(), self.offset)
 
-    def timedOccurrences(self, start, end):
-        return ((c + self.offset for c in self.child.timedOccurrences(start, end)))
+    def simplify(self):
+        child = self.child.simplify()
+        offset = self.offset
+        if isinstance(child, Offset):
+            offset += child.offset
+            child = child.child
+        if not offset or isEmpty(child):
+            return child
+        # these shift exactly by whole days
+        if (isinstance(child, (DateSet, Daily, Weekly)) and
+            not (offset.seconds or offset.microseconds)):
+            try:
+                return child + offset
+            except OverflowError:
+                pass
+        return Offset(child, offset)
+
+    def testsDates(self):
+        return False
+
+    # the child's occurrences move by the offset's days, or one more
+    # if their time of day crosses midnight, so ask the child for a
+    # slightly wider window and drop whatever lands outside ours.
+    # An enclosing period's span only sets the times, on whatever date
+    # the offset moved the child's occurrence to.
+    def timedOccurrences(self, start, end, span=None):
+        first = start.toordinal()
+        last = end.toordinal()
+        days = self.offset.days
+        shift = days * 1440 + self.offset.seconds / 60
+        for c in self.child.compile().expand(clampedDate(first - days - 1),
+                                             clampedDate(last - days)):
+            day = c.day_ordinal + (c.start_minute + shift) // 1440
+            if not first <= day <= last:
+                continue
+            if span is None:
+                yield c + self.offset
+            else:
+                yield Occurrence.fromMinutes(c.ordinal, span[0], day,
+                                             span[1], span[2])
+
+    # shifting by whole days moves every occurrence by the same number
+    # of dates, otherwise we have to look
+    def countOccurrences(self, start, end):
+        if self.offset.seconds or self.offset.microseconds:
+            return Node.countOccurrences(self, start, end)
+        days = self.offset.days
+        return self.child.countOccurrences(
+            clampedDate(start.toordinal() - days),
+            clampedDate(end.toordinal() - days))
+
+    def onePerDay(self):
+        return self.child.onePerDay()
+
+    def period(self):
+        return self.child.period()
+
+    # occurrences on a given date come from the child's occurrences
+    # on the date offset.days before, or the one before that
+    def ordinalStep(self, days, date):
+        date = shiftBound(date, -self.offset.days - self.extraDays())
+        return self.child.ordinalStep(days, date)
+
+    def advanceOrdinal(self, ordinal, count, step):
+        return self.child.advanceOrdinal(ordinal, count, step)
+
+    def extraDays(self):
+        return 1 if (self.offset.seconds or self.offset.microseconds) else 0
+
+    def bounds(self):
+        earliest, latest = self.child.bounds()
+        days = self.offset.days
+        return (shiftBound(earliest, days),
+                shiftBound(latest, days + self.extraDays()))
+
+    def steadyBounds(self):
+        earliest, latest = self.child.steadyBounds()
+        days = self.offset.days
+        return (shiftBound(earliest, days + self.extraDays()),
+                shiftBound(latest, days))
+
+    def nextDate(self, date):
+        occurrence = self.nextOccurrence(shiftDatetime(
+            datetime.datetime.fromordinal(date.toordinal()), -epsilon))
+        return occurrence.date if occurrence else None
+
+    def previousDate(self, date):
+        occurrence = self.previousOccurrence(shiftDatetime(
+            datetime.datetime.fromordinal(date.toordinal()), one_day))
+        return occurrence.date if occurrence else None
+
+    def nextOccurrence(self, after):
+        occurrence = self.child.nextOccurrence(shiftDatetime(after, -self.offset))
+        return occurrence + self.offset if occurrence else None
+
+    def previousOccurrence(self, before):
+        occurrence = self.child.previousOccurrence(shiftDatetime(before, -self.offset))
+        return occurrence + self.offset if occurrence else None
         
-class NthWeekday(Node):
+class NthWeekday(MonthSlots):
 
     def __init__(self, n, month, *weekdays):
-        Node.__init__(self, n, month, *weekdays)
+        Node.__init__(self, n, month, *sorted(set(weekdays)))
         self.n = n
         self.month = month
         self.days = set(weekdays)
@@ -346,68 +1263,64 @@ class NthWeekday(Node):
         return Offset(self, delta)
 
     def toEnglish(self):
-        n = toOrdinal(self.n)
+        if self.n == -1:
+            n = "last"
+        elif self.n < 0:
+            n = "%s to last" % toOrdinal(-self.n)
+        else:
+            n = toOrdinal(self.n)
         days = ", ".join((daynames[d] for d in self.days))
         if not self.month:
             return "every %s %s" % (n, days)
         else:
-            return "every %s %s of each %s" % (n, days, monthnames[month])          
-
-    def ordinal(self, date):
-        def weekdays_in_month(weekday, month, year):
-            first = datetime.date(year, month, 1)
-            last = datetime.date(year, month, (self.last_day_year_month(year, month) / 7))
-            base = 3
-            if first.weekday() <= weekday:
-                base += 1
-            if last.weekday() >= weekday:
-                base += 1
-
-        if self.month:
-            count = 0
-            for year in xrange(1, date.year):
-                for day in self.days:
-                    if abs(self.n) <= weekdays_in_month(day, self.month, year):
-                        count += 1
-            return count
-
-
-        count = 0
-        for year in xrange(1, date.year):
-            for month in xrange(1, date.month):
-                for day in self.days:
-                    if abs(self.n) <= weekdays_in_month(day, month, year):
-                        count += 1
-        return count
-        
-    def occursOnDate(self, date):
-        if self.month and not date.month == self.month:
+            return "every %s %s of %s" % (n, days, monthnames[self.month - 1])
+
+    def daysInSlot(self, slot):
+        first, last = calendarTable.monthFields(*self.slotMonth(slot))
+        days = []
+        for weekday in self.days:
+            if self.n > 0:
+                day = 1 + (weekday - first) % 7 + 7 * (self.n - 1)
+            else:
+                day = last - (first + last - 1 - weekday) % 7 + 7 * (self.n + 1)
+            if 1 <= day <= last:
+                days.append(day)
+        days.sort()
+        return days
+
+    def daysPerSlot(self):
+        if 1 <= abs(self.n) <= 4:
+            return len(self.days)
+        return None
+
+    def occursOnOrdinal(self, ordinal):
+        block, i = calendarTable.lookup(ordinal)
+        if self.month and not block.month[i] == self.month:
             return False
-        first_of_month = datetime.date(date.year, date.month, 1)
-        nth = (date.day / 7)
-        if first_of_month.weekday() <= date.weekday():
-            nth += 1
-        return (nth == self.n) and (date.weekday() in self.days)
-
-    last_days = {
-        11 : 30,
-        4 : 30,
-        6 : 30,
-        7 : 30,
-        9 : 30,
-        }
-    
-    def last_day(self, date):
-        month = date.month
-        if month == 2:
-            return 29 if ((date.year % 4) == 0) else 28
-        return self.last_days.get(month, 31)
-
-
-    def last_day_year_month(self, year, month):
-        if month == 2:
-            return 29 if ((year % 4) == 0) else 28
-        return self.last_days.get(month, 31)
+        if not block.weekday[i] in self.days:
+            return False
+        if self.n > 0:
+            return block.nth[i] == self.n
+        return block.nth_last[i] == -self.n
+
+    def compileTest(self):
+        lookup = calendarTable.lookup
+        month, days = self.month, frozenset(self.days)
+        field, n = ("nth", self.n) if self.n > 0 else ("nth_last", -self.n)
+        def test(ordinal):
+            block, i = lookup(ordinal)
+            return ((not month or block.month[i] == month) and
+                    block.weekday[i] in days and
+                    getattr(block, field)[i] == n)
+        return test
+
+    def ordinalMask(self, ordinals, fields):
+        mask = weekdayMask(self.days, fields)
+        if self.month:
+            mask &= fields.month == self.month
+        if self.n > 0:
+            return mask & ((fields.day - 1) // 7 + 1 == self.n)
+        return mask & ((fields.days_in_month - fields.day) // 7 + 1 == -self.n)
     
 class And(Node):
 
@@ -422,17 +1335,121 @@ class And(Node):
     def toAllday(self):
         return And(self.a.toAllday(), self.b.toAllday())
 
+    # merges date sets, weekday sets and periods with the same times
+    # into one branch each
+    def simplify(self):
+        groups = {}
+        branches = []
+        for branch in self.branches():
+            branch = branch.simplify()
+            for branch in (branch.branches() if isinstance(branch, And)
+                           else (branch,)):
+                if isinstance(branch, DateSet):
+                    key, items = DateSet, branch.dates
+                elif isinstance(branch, Weekly):
+                    key, items = Weekly, branch.days
+                elif isinstance(branch, Period):
+                    key, items = (branch.start, branch.end), [branch.child]
+                else:
+                    branches.append(branch)
+                    continue
+                if key not in groups:
+                    groups[key] = []
+                    branches.append(key)
+                groups[key].extend(items)
+        for i, key in enumerate(branches):
+            if key in (DateSet, Weekly):
+                branches[i] = key(*set(groups[key])).simplify()
+            elif isinstance(key, tuple):
+                branches[i] = Period(reduce(And, groups[key]), *key).simplify()
+        branches = [b for b in branches if not isEmpty(b)]
+        if not branches:
+            return DateSet()
+        return reduce(And, branches)
+
     def toEnglish(self):
         return "(%s) and (%s)" % (self.a.toEnglish(), self.b.toEnglish())
 
-    def timedOccurrences(self, start, end):
+    def testsDates(self):
+        return self.a.testsDates() and self.b.testsDates()
+
+    def occursOnOrdinal(self, ordinal):
+        return self.a.occursOnOrdinal(ordinal) or self.b.occursOnOrdinal(ordinal)
+
+    def compileTest(self):
+        tests = [branch.compile().test for branch in self.branches()]
+        if None in tests:
+            return None
+        def test(ordinal):
+            for t in tests:
+                if t(ordinal):
+                    return True
+            return False
+        return test
+
+    def ordinalMask(self, ordinals, fields):
+        return (self.a.ordinalMask(ordinals, fields) |
+                self.b.ordinalMask(ordinals, fields))
+
+    def countOccurrences(self, start, end):
+        return sum(branch.countOccurrences(start, end)
+                   for branch in self.branches())
+
+    def onePerDay(self):
+        return False
+
+    def period(self):
+        return reduce(lcm, (branch.period() for branch in self.branches()))
+
+    # ordinals are (branch index, ordinal) pairs, so there's a step
+    # for each branch
+    def ordinalStep(self, days, date):
+        return [(branch, branch.ordinalStep(days, date))
+                for branch in self.branches()]
+
+    def advanceOrdinal(self, ordinal, count, step):
+        index, ordinal = ordinal
+        branch, step = step[index]
+        return index, branch.advanceOrdinal(ordinal, count, step)
+
+    def bounds(self):
+        spans = [branch.bounds() for branch in self.branches()]
+        return min(s[0] for s in spans), max(s[1] for s in spans)
+
+    def nextDate(self, date):
+        dates = [d for d in (self.a.nextDate(date), self.b.nextDate(date)) if d]
+        return min(dates) if dates else None
+
+    def previousDate(self, date):
+        dates = [d for d in (self.a.previousDate(date), self.b.previousDate(date)) if d]
+        return max(dates) if dates else None
+
+    def toBitmap(self, start, end):
+        return self.a.toBitmap(start, end) | self.b.toBitmap(start, end)
+
+    # nested Ands are merged together as one, with ordinals tagged by
+    # the position of the branch they came from.
+    def branches(self):
+        for child in self.children:
+            if isinstance(child, And):
+                for branch in child.branches():
+                    yield branch
+            else:
+                yield child
+
+    def timedOccurrences(self, start, end, span=None):
         # for now if there are overlapping occurrences in either set,
         # we return them both. In the future we may wisth to merge
         # overlapping events together
-        values = list((v.clone(ordinal=(0, v.ordinal)) for v in self.a.timedOccurrences(start, end)))
-        values.extend((v.clone(ordinal=(1, v.ordinal)) for v in self.b.timedOccurrences(start, end)))
-        values.sort(key=lambda x: x.start)
-        return iter(values)
+        def tagged(index, occurrences):
+            for count, occurrence in enumerate(occurrences):
+                occurrence.ordinal = (index, occurrence.ordinal)
+                yield occurrence.key[0], index, count, occurrence
+
+        streams = [tagged(i, branch.compile().expand(start, end, span))
+                   for i, branch in enumerate(self.branches())]
+        for key in heapq.merge(*streams):
+            yield key[-1]
 
 
 class Except(Node):
@@ -448,21 +1465,120 @@ class Except(Node):
     def toAllday(self):
         return Except(self.include.toAllday(), self.exclude.toAllday())
 
+    def simplify(self):
+        include = self.include.simplify()
+        exclude = self.exclude.simplify()
+        if isinstance(include, Except):
+            exclude = And(include.exclude, exclude).simplify()
+            include = include.include
+        if isEmpty(include) or isEmpty(exclude):
+            return include
+        if isinstance(include, DateSet) and exclude.testsDates():
+            return DateSet(*(d for d in include.dates
+                             if not exclude.occursOnDate(d)))
+        return Except(include, exclude)
+
     def toEnglish(self):
         return "(%s) except (%s)" % (self.include.toEnglish(), self.exclude.toEnglish())
 
-    def timedOccurrences(self, start, end):
+    def testsDates(self):
+        return self.include.testsDates() and self.exclude.testsDates()
+
+    def occursOnOrdinal(self, ordinal):
+        return (self.include.occursOnOrdinal(ordinal) and
+                not self.exclude.occursOnOrdinal(ordinal))
+
+    def compileTest(self):
+        include = self.include.compile().test
+        exclude = self.exclude.compile().test
+        if include is None or exclude is None:
+            return None
+        return lambda ordinal: include(ordinal) and not exclude(ordinal)
+
+    def ordinalMask(self, ordinals, fields):
+        return (self.include.ordinalMask(ordinals, fields) &
+                ~self.exclude.ordinalMask(ordinals, fields))
+
+    # when the included recurrence occurs at most once a day, the
+    # count is the number of days left after excluding
+    def countOccurrences(self, start, end):
+        if not self.include.onePerDay():
+            return Node.countOccurrences(self, start, end)
+        return bin(self.toBitmap(start, end)).count("1")
+
+    def onePerDay(self):
+        return self.include.onePerDay()
+
+    def bounds(self):
+        return self.include.bounds()
+
+    def period(self):
+        return lcm(self.include.period(), self.exclude.period())
+
+    def ordinalStep(self, days, date):
+        return self.include.ordinalStep(days, date)
+
+    def advanceOrdinal(self, ordinal, count, step):
+        return self.include.advanceOrdinal(ordinal, count, step)
+
+    def excludes(self, date):
+        if self.exclude.testsDates():
+            return self.exclude.occursOnDate(date)
+        for occurrence in self.exclude.timedOccurrences(date, date):
+            return True
+        return False
+
+    def nextDate(self, date):
+        limit = date.toordinal() + search_horizon
+        date = self.include.nextDate(date)
+        while date and self.excludes(date):
+            if date.toordinal() > limit or date == datetime.date.max:
+                return None
+            date = self.include.nextDate(date + one_day)
+        return date
+
+    def previousDate(self, date):
+        limit = date.toordinal() - search_horizon
+        date = self.include.previousDate(date)
+        while date and self.excludes(date):
+            if date.toordinal() < limit or date == datetime.date.min:
+                return None
+            date = self.include.previousDate(date - one_day)
+        return date
+
+    def toBitmap(self, start, end):
+        return (self.include.toBitmap(start, end) &
+                ~self.exclude.toBitmap(start, end))
+
+    def timedOccurrences(self, start, end, span=None):
         # for now we exclude any occurrences which occur on the same
         # date as an occurrence in our exclusion list. In the future
         # we may wish to subtract out the intersection of the include
         # and exclude recurrences.
-        include = list(self.include.timedOccurrences(start, end))
-        include.sort()
-        exclude = set((o.date for o in self.exclude.timedOccurrences(start, end)))
-        for value in include:
-            if not value.date in exclude:
+        excluded = self.exclude.compile().test
+        if excluded is None:
+            excluded = DateCursor(
+                self.exclude.compile().expand(start, end)).occursOnOrdinal
+        for value in self.include.compile().expand(start, end, span):
+            if not excluded(value.day_ordinal):
                 yield value
 
+class DateCursor(object):
+
+    # Tests whether a stream of occurrences has any on a given date,
+    # consuming the stream as it goes. Dates must be tested in order.
+
+    def __init__(self, occurrences):
+        self.ordinals = (o.day_ordinal for o in occurrences)
+        self.ordinal = next(self.ordinals, None)
+
+    def occursOnOrdinal(self, ordinal):
+        while (self.ordinal is not None) and (self.ordinal < ordinal):
+            self.ordinal = next(self.ordinals, None)
+        return self.ordinal == ordinal
+
+    def occursOnDate(self, date):
+        return self.occursOnOrdinal(date.toordinal())
 
 class Filter(Node):
 
@@ -474,14 +1590,33 @@ class Filter(Node):
     def __add__(self, delta):
         return type(self)(self.child + delta, *(c + delta for c in self.args))
 
-    def occursOnDate(self, date):
-        return self.filter(date) and self.child.occursOnDate(date)
+    def testsDates(self):
+        return self.child.testsDates()
+
+    def onePerDay(self):
+        return self.child.onePerDay()
+
+    def bounds(self):
+        return self.child.bounds()
+
+    def period(self):
+        return self.child.period()
+
+    def ordinalStep(self, days, date):
+        return self.child.ordinalStep(days, date)
 
-    def timedOccurrences(self, start, end):
-        return (p for p in self.child.timedOccurrences(start, end)
-                if self.filter(p))
+    def advanceOrdinal(self, ordinal, count, step):
+        return self.child.advanceOrdinal(ordinal, count, step)
 
-    def filter(self, period):
+    def occursOnOrdinal(self, ordinal):
+        return self.filter(ordinal) and self.child.occursOnOrdinal(ordinal)
+
+    def timedOccurrences(self, start, end, span=None):
+        return (p for p in self.child.compile().expand(start, end, span)
+                if self.filter(p.day_ordinal))
+
+    # whether to keep the child's occurrences on the given day ordinal
+    def filter(self, ordinal):
         raise NotImplemented
 
     def toAllday(self):
@@ -492,16 +1627,142 @@ class From(Filter):
     def toEnglish(self):
         return "(%s) from %s" % (self.child.toEnglish(), dateToStr(self.args[0]))
 
-    def filter(self, period):
-        return period.date >= self.args[0]
+    def filter(self, ordinal):
+        return ordinal >= self.args[0].toordinal()
+
+    def compileTest(self):
+        test = self.child.compile().test
+        if test is None:
+            return None
+        first = self.args[0].toordinal()
+        return lambda ordinal: ordinal >= first and test(ordinal)
+
+    # rather than filter the child's occurrences, narrow its window
+    def compileExpansion(self):
+        expand = self.child.compile().expand
+        first = self.args[0]
+        def expansion(start, end, span=None):
+            start = max(start, first)
+            if start > end:
+                return ()
+            return expand(start, end, span)
+        return expansion
+
+    # bounds are pushed below periods and above until, and folded into
+    # date sets and the start of a daily recurrence
+    def simplify(self):
+        child = self.child.simplify()
+        date = self.args[0]
+        if isinstance(child, From):
+            return From(child.child, max(date, child.args[0])).simplify()
+        if isinstance(child, Until):
+            return Until(From(child.child, date), child.args[0]).simplify()
+        if isinstance(child, Period):
+            return Period(From(child.child, date),
+                          child.start, child.end).simplify()
+        earliest, latest = child.bounds()
+        if latest < max(earliest, date):
+            return DateSet()
+        if earliest >= date:
+            return child
+        if isinstance(child, DateSet):
+            return DateSet(*(d for d in child.dates if d >= date))
+        if isinstance(child, Daily):
+            return Daily(child.nextDate(date), child.step)
+        return From(child, date)
+
+    def ordinalMask(self, ordinals, fields):
+        return (self.child.ordinalMask(ordinals, fields) &
+                (ordinals >= self.args[0].toordinal()))
+
+    def bounds(self):
+        earliest, latest = self.child.bounds()
+        return max(earliest, self.args[0]), latest
+
+    def countOccurrences(self, start, end):
+        start = max(start, self.args[0])
+        if start > end:
+            return 0
+        return self.child.countOccurrences(start, end)
+
+    def nextDate(self, date):
+        return self.child.nextDate(max(date, self.args[0]))
+
+    def previousDate(self, date):
+        date = self.child.previousDate(date)
+        return date if date and date >= self.args[0] else None
+
+    def toBitmap(self, start, end):
+        first = self.args[0].toordinal() - start.toordinal()
+        return (self.child.toBitmap(start, end) &
+                rangeBitmap(first, windowLength(start, end) - 1))
 
 class Until(Filter):
 
     def toEnglish(self):
         return "(%s) until %s" % (self.child.toEnglish(), dateToStr(self.args[0]))
 
-    def filter(self, period):
-        return period.date <= self.args[0]
+    def filter(self, ordinal):
+        return ordinal <= self.args[0].toordinal()
+
+    def compileTest(self):
+        test = self.child.compile().test
+        if test is None:
+            return None
+        last = self.args[0].toordinal()
+        return lambda ordinal: ordinal <= last and test(ordinal)
+
+    def compileExpansion(self):
+        expand = self.child.compile().expand
+        last = self.args[0]
+        def expansion(start, end, span=None):
+            end = min(end, last)
+            if start > end:
+                return ()
+            return expand(start, end, span)
+        return expansion
+
+    def simplify(self):
+        child = self.child.simplify()
+        date = self.args[0]
+        if isinstance(child, Until):
+            return Until(child.child, min(date, child.args[0])).simplify()
+        if isinstance(child, Period):
+            return Period(Until(child.child, date),
+                          child.start, child.end).simplify()
+        earliest, latest = child.bounds()
+        if min(latest, date) < earliest:
+            return DateSet()
+        if latest <= date:
+            return child
+        if isinstance(child, DateSet):
+            return DateSet(*(d for d in child.dates if d <= date))
+        return Until(child, date)
+
+    def ordinalMask(self, ordinals, fields):
+        return (self.child.ordinalMask(ordinals, fields) &
+                (ordinals <= self.args[0].toordinal()))
+
+    def bounds(self):
+        earliest, latest = self.child.bounds()
+        return earliest, min(latest, self.args[0])
+
+    def countOccurrences(self, start, end):
+        end = min(end, self.args[0])
+        if start > end:
+            return 0
+        return self.child.countOccurrences(start, end)
+
+    def nextDate(self, date):
+        date = self.child.nextDate(date)
+        return date if date and date <= self.args[0] else None
+
+    def previousDate(self, date):
+        return self.child.previousDate(min(date, self.args[0]))
+
+    def toBitmap(self, start, end):
+        last = self.args[0].toordinal() - start.toordinal()
+        return self.child.toBitmap(start, end) & rangeBitmap(0, last)
 
 import itertools
 
@@ -513,40 +1774,151 @@ class For(Filter):
     def toEnglish(self):
         return "(%s) repeating %d times" % (self.child.toEnglish(), self.args[0])
 
-    def timedOccurrences(self, start, end):
-        return (c for c in self.child.timedOccurrences(start, end) if
-                c.id < self.args[0])
+    def simplify(self):
+        child = self.child.simplify()
+        if self.args[0] <= 0 or isEmpty(child):
+            return DateSet()
+        if isinstance(child, DateSet):
+            return DateSet(*child.children[:self.args[0]])
+        return For(child, *self.args)
+
+    def testsDates(self):
+        return False
+
+    # the number of the child's occurrences before the given date,
+    # counting from its first. Only children with a first date, like
+    # From or Daily, give counts that mean anything; the parser adds a
+    # From when there isn't one.
+    def countBefore(self, date):
+        first = self.child.nextDate(datetime.date.min)
+        if first is None or date <= first:
+            return 0
+        return self.child.countOccurrences(first, date - one_day)
+
+    def timedOccurrences(self, start, end, span=None):
+        left = self.args[0] - self.countBefore(start)
+        if left <= 0:
+            return
+        for c in self.child.compile().expand(start, end, span):
+            yield c
+            left -= 1
+            if not left:
+                return
+
+    def countOccurrences(self, start, end):
+        left = self.args[0] - self.countBefore(start)
+        return max(0, min(left, self.child.countOccurrences(start, end)))
+
+    def period(self):
+        return None
+
+    def nextDate(self, date):
+        date = self.child.nextDate(date)
+        if date is None or self.countBefore(date) >= self.args[0]:
+            return None
+        return date
+
+    # ends on the date of the last occurrence, if it can be found
+    # within the search horizon
+    def bounds(self):
+        first = self.child.nextDate(datetime.date.min)
+        if first is None or self.args[0] <= 0:
+            return datetime.date.max, datetime.date.min
+        latest = self.child.bounds()[1]
+        end = min(latest, clampedDate(first.toordinal() + search_horizon))
+        occurrences = itertools.islice(
+            self.child.compile().expand(first, end), self.args[0])
+        last = None
+        for count, occurrence in enumerate(occurrences):
+            last = occurrence.date
+        if last is not None and count + 1 == self.args[0]:
+            return first, last
+        return first, latest
 
 class Period(Filter):
 
+    # end is either a time of day or a duration
     def __init__(self, child, start, end):
         Filter.__init__(self, child, start, end)
         self.child = child
         self.start = start
         self.end = end
+        first = start.hour * 60 + start.minute
+        if isinstance(end, datetime.timedelta):
+            last = first + end.days * 1440 + end.seconds / 60
+        else:
+            last = end.hour * 60 + end.minute
+        self.span = (self, first, last)
 
     def __add__(self, delta):
+        end = self.end
+        if not isinstance(end, datetime.timedelta):
+            end = timePlusTimedelta(end, delta)
         return Period(self.child + delta,
-                      timePlusTimedelta(self.start, delta),
-                      timePlusTimedelta(self.end, delta))
+                      timePlusTimedelta(self.start, delta), end)
 
     def toEnglish(self):
         if isinstance(self.end, datetime.timedelta):
             return "(%s) at %s for %s" % \
-                (self.child.toEnglish(), timeToStr(self.start), timeToStr(self.end))
+                (self.child.toEnglish(), timeToStr(self.start),
+                 durationToStr(self.end))
         return "(%s) from %s until %s" %\
             (self.child.toEnglish(), timeToStr(self.start), timeToStr(self.end))
     
-    def filter(self, date):
+    def filter(self, ordinal):
         return True
 
-    def timedOccurrences(self, start, end):
-        for c in self.child.timedOccurrences(start, end):
-            yield c.clone(creator=self, start=self.start, end=self.end)
+    def compileTest(self):
+        return self.child.compile().test
+
+    def simplify(self):
+        child = self.child.simplify()
+        if isEmpty(child):
+            return child
+        return Period(child, self.start, self.end)
+
+    def ordinalMask(self, ordinals, fields):
+        return self.child.ordinalMask(ordinals, fields)
+
+    def toBitmap(self, start, end):
+        return self.child.toBitmap(start, end)
+
+    def countOccurrences(self, start, end):
+        return self.child.countOccurrences(start, end)
+
+    def nextDate(self, date):
+        return self.child.nextDate(date)
+
+    def previousDate(self, date):
+        return self.child.previousDate(date)
+
+    # the outermost period sets the times, so our span only applies
+    # when there isn't one already
+    def timedOccurrences(self, start, end, span=None):
+        return self.child.compile().expand(start, end, span or self.span)
 
     def toAllday(self):
         return self.child.toAllday()
 
+    # moving the start keeps the end where it was, even when the end
+    # is a duration, and neither end can be dragged past the other
+    def withStart(self, start):
+        last = self.span[2]
+        minute = min(start.hour * 60 + start.minute, last)
+        start = datetime.time(minute / 60 % 24, minute % 60)
+        if isinstance(self.end, datetime.timedelta):
+            return Period(self.child, start,
+                          datetime.timedelta(minutes=last - minute))
+        return Period(self.child, start, self.end)
+
+    def withEnd(self, end):
+        if isinstance(self.end, datetime.timedelta):
+            first = self.span[1]
+            minutes = max(end.hour * 60 + end.minute - first, 0)
+            return Period(self.child, self.start,
+                          datetime.timedelta(minutes=minutes))
+        return Period(self.child, self.start, max(end, self.start))
+
 if __name__ == '__main__':
 
     delta = datetime.timedelta(days=1, hours=1)
@@ -566,6 +1938,13 @@ if __name__ == '__main__':
             print "exp: ", [(str(a), str(b)) for a, b in expected]
             print "got: ", [(str(a), str(b)) for a, b in values]
 
+    def test_ordinals(recurrence, daterange, expected):
+        values = [o.ordinal for o in recurrence.timedOccurrences(*daterange)]
+        if not values == expected:
+            print "failure: ", str(recurrence)
+            print "exp: ", expected
+            print "got: ", values
+
     test_range(DateSet(datetime.date(2011, 3, 1), datetime.date(2011, 3, 5),
                        datetime.date(2011, 3, 10)),
                daterange,
@@ -603,20 +1982,91 @@ if __name__ == '__main__':
                         datetime.date(2011, 3, 7),
                         datetime.date(2011, 3, 10)]))
 
+    test_ordinals(Daily(datetime.date(2011, 2, 25), 2),
+                  daterange,
+                  [2, 3, 4, 5, 6])
+
+    test_range(Daily(datetime.date(2011, 3, 4), 3),
+               (datetime.date(2001, 1, 1), datetime.date(2011, 3, 10)),
+               all_day([datetime.date(2011, 3, 4),
+                        datetime.date(2011, 3, 7),
+                        datetime.date(2011, 3, 10)]))
+
+    test_ordinals(Daily(datetime.date(2011, 3, 4), 3),
+                  (datetime.date(2001, 1, 1), datetime.date(2011, 3, 10)),
+                  [0, 1, 2])
+
     test_range(Weekly(0, 2),
                daterange,
                all_day([datetime.date(2011, 3, 2),
                 datetime.date(2011, 3, 7),
                 datetime.date(2011, 3, 9)]))
 
+    # 209771 mondays and wednesdays precede 3/2/2011
+    test_ordinals(Weekly(0, 2),
+                  daterange,
+                  [209771, 209772, 209773])
+
+    test_range(Weekly(3, 6),
+               (datetime.date(1, 1, 1), datetime.date(1, 1, 14)),
+               all_day([datetime.date(1, 1, 4),
+                        datetime.date(1, 1, 7),
+                        datetime.date(1, 1, 11),
+                        datetime.date(1, 1, 14)]))
+
     test_range(Monthly(None, 5),
                daterange,
                all_day([datetime.date(2011, 3, 5)]))
 
+    # months without a 31st are skipped
+    test_range(Monthly(None, 31),
+               (datetime.date(2011, 1, 1), datetime.date(2011, 6, 30)),
+               all_day([datetime.date(2011, 1, 31),
+                        datetime.date(2011, 3, 31),
+                        datetime.date(2011, 5, 31)]))
+
+    # 7 31st's a year since 1/0001
+    test_ordinals(Monthly(None, 31),
+                  (datetime.date(2011, 1, 1), datetime.date(2011, 6, 30)),
+                  [14070, 14071, 14072])
+
+    test_range(Monthly(2, 29),
+               (datetime.date(2011, 1, 1), datetime.date(2013, 12, 31)),
+               all_day([datetime.date(2012, 2, 29)]))
+
+    # one 2/29 per leap year since 1/0001
+    test_ordinals(Monthly(2, 29),
+                  (datetime.date(2011, 1, 1), datetime.date(2013, 12, 31)),
+                  [487])
+
     test_range(NthWeekday(2, None, 0, 2),
                daterange,
                all_day([datetime.date(2011, 3, 9)]))
 
+    test_range(NthWeekday(-1, None, 2),
+               daterange,
+               all_day([]))
+
+    test_range(NthWeekday(-1, None, 2),
+               (datetime.date(2011, 3, 1), datetime.date(2011, 3, 31)),
+               all_day([datetime.date(2011, 3, 30)]))
+
+    test_range(NthWeekday(-2, 3, 0),
+               (datetime.date(2011, 1, 1), datetime.date(2012, 12, 31)),
+               all_day([datetime.date(2011, 3, 21),
+                        datetime.date(2012, 3, 19)]))
+
+    test_range(NthWeekday(5, None, 1),
+               (datetime.date(2011, 1, 1), datetime.date(2011, 12, 31)),
+               all_day([datetime.date(2011, 3, 29),
+                        datetime.date(2011, 5, 31),
+                        datetime.date(2011, 8, 30),
+                        datetime.date(2011, 11, 29)]))
+
+    test_ordinals(NthWeekday(5, None, 1),
+                  (datetime.date(2011, 5, 1), datetime.date(2011, 12, 31)),
+                  [8398, 8399, 8400])
+
     test_range(And(Weekly(0, 2, 4), DateSet(datetime.date(2011, 3, 8))),
                daterange,
                all_day([datetime.date(2011, 3, 2),
@@ -625,6 +2075,21 @@ if __name__ == '__main__':
                 datetime.date(2011, 3, 8),
                 datetime.date(2011, 3, 9)]))
 
+    test_range(And(And(Weekly(4), DateSet(datetime.date(2011, 3, 8))),
+                   Daily(datetime.date(2011, 3, 1), 4)),
+               daterange,
+               all_day([datetime.date(2011, 3, 1),
+                        datetime.date(2011, 3, 4),
+                        datetime.date(2011, 3, 5),
+                        datetime.date(2011, 3, 8),
+                        datetime.date(2011, 3, 9)]))
+
+    test_ordinals(And(And(DateSet(datetime.date(2011, 3, 8)),
+                          DateSet(datetime.date(2011, 3, 2))),
+                      Daily(datetime.date(2011, 3, 1), 4)),
+                  daterange,
+                  [(2, 0), (1, 0), (2, 1), (0, 0), (2, 2)])
+
     test_range(Except(Daily(datetime.date(2011, 2, 28), 2), Weekly(1)),
                daterange,
                all_day([datetime.date(2011, 3, 2),
@@ -632,6 +2097,22 @@ if __name__ == '__main__':
                 datetime.date(2011, 3, 6),
                 datetime.date(2011, 3, 10)]))
 
+    test_range(Except(Daily(datetime.date(2011, 3, 1), 1),
+                      NthWeekday(-1, None, 2)),
+               (datetime.date(2011, 3, 28), datetime.date(2011, 4, 1)),
+               all_day([datetime.date(2011, 3, 28),
+                        datetime.date(2011, 3, 29),
+                        datetime.date(2011, 3, 31),
+                        datetime.date(2011, 4, 1)]))
+
+    # excluding an Offset can't test dates directly
+    test_range(Except(Weekly(0, 2, 4),
+                      Offset(Monthly(None, 3), datetime.timedelta(days=1))),
+               daterange,
+               all_day([datetime.date(2011, 3, 2),
+                        datetime.date(2011, 3, 7),
+                        datetime.date(2011, 3, 9)]))
+
     test_range(Period(Daily(datetime.date(2011, 2, 28), 3),
                       datetime.time(16, 35),
                       datetime.time(17, 45)),
@@ -643,6 +2124,126 @@ if __name__ == '__main__':
                 (datetime.datetime(2011, 3, 9, 16, 35),
                  datetime.datetime(2011, 3, 9, 17, 45))])
                       
+
+    test_range(Offset(Period(DateSet(datetime.date(2011, 3, 2)),
+                             datetime.time(22, 00),
+                             datetime.time(23, 30)),
+                      datetime.timedelta(hours=1)),
+               daterange,
+               [(datetime.datetime(2011, 3, 2, 23, 00),
+                 datetime.datetime(2011, 3, 3, 0, 30))])
+
+    assert (Occurrence(0, None, datetime.date(2011, 3, 2)) ==
+            Occurrence(1, None, datetime.date(2011, 3, 2)))
+
+    assert (Occurrence(0, None, datetime.date(2011, 3, 2)) <
+            Occurrence(0, None, datetime.date(2011, 3, 2),
+                       datetime.time(1, 0), datetime.time(2, 0)))
+
+    ## test bitmaps
+
+    def test_bitmap(recurrence, daterange):
+        expected = [o.date for o in recurrence.timedOccurrences(*daterange)]
+        values = list(bitmapDates(recurrence.toBitmap(*daterange), daterange[0]))
+        if not values == expected:
+            print "failure: ", str(recurrence)
+            print "exp: ", [str(d) for d in expected]
+            print "got: ", [str(d) for d in values]
+
+    assert Weekly(0, 2).toBitmap(*daterange) == int("0101000010", 2)
+
+    longrange = (datetime.date(2010, 12, 25), datetime.date(2012, 1, 10))
+
+    test_bitmap(Daily(datetime.date(2011, 2, 25), 3), longrange)
+    test_bitmap(Monthly(None, 31), longrange)
+    test_bitmap(Except(Daily(datetime.date(2010, 1, 1), 2),
+                       And(Weekly(1, 3), NthWeekday(-1, None, 4))),
+                longrange)
+    test_bitmap(Until(From(Weekly(5), datetime.date(2011, 3, 1)),
+                      datetime.date(2011, 6, 1)),
+                longrange)
+    test_bitmap(Offset(Monthly(None, 1), datetime.timedelta(days=-1)),
+                longrange)
+
+    ## test vectorized date tests
+
+    def test_ordinals_mask(recurrence, daterange):
+        ordinals = range(daterange[0].toordinal(), daterange[1].toordinal() + 1)
+        expected = [recurrence.occursOnDate(datetime.date.fromordinal(o))
+                    for o in ordinals]
+        values = [bool(v) for v in recurrence.occursOnOrdinals(ordinals)]
+        if not values == expected:
+            print "failure: ", str(recurrence)
+
+    test_ordinals_mask(DateSet(datetime.date(2011, 3, 5)), longrange)
+    test_ordinals_mask(Daily(datetime.date(2011, 2, 25), 3), longrange)
+    test_ordinals_mask(Monthly(2, 29), (datetime.date(1999, 1, 1),
+                                        datetime.date(2001, 1, 1)))
+    test_ordinals_mask(NthWeekday(-2, None, 1, 4), longrange)
+    test_ordinals_mask(Except(Until(Weekly(0, 6), datetime.date(2011, 9, 1)),
+                              And(NthWeekday(1, 5, 0), Monthly(None, 31))),
+                       longrange)
+
+    ## test counting
+
+    def test_count(recurrence, daterange):
+        expected = len(list(recurrence.timedOccurrences(*daterange)))
+        value = recurrence.countOccurrences(*daterange)
+        if not value == expected:
+            print "failure: ", str(recurrence)
+            print "exp: ", expected
+            print "got: ", value
+
+    test_count(Daily(datetime.date(2011, 2, 25), 3), longrange)
+    test_count(Weekly(0, 3, 5), longrange)
+    test_count(Monthly(None, 31), longrange)
+    test_count(Monthly(3, 23), longrange)
+    test_count(NthWeekday(5, None, 6), longrange)
+    test_count(And(Weekly(1), Daily(datetime.date(2011, 1, 1), 2)), longrange)
+    test_count(Except(Daily(datetime.date(2011, 1, 1), 2),
+                      Offset(Weekly(1), datetime.timedelta(days=1))),
+               longrange)
+    test_count(Until(From(Weekly(2), datetime.date(2011, 2, 1)),
+                     datetime.date(2011, 8, 1)), longrange)
+
+    test_range(For(Daily(datetime.date(2011, 3, 1), 2), 3),
+               daterange,
+               all_day([datetime.date(2011, 3, 1),
+                        datetime.date(2011, 3, 3),
+                        datetime.date(2011, 3, 5)]))
+
+    test_range(For(Daily(datetime.date(2011, 3, 1), 2), 3),
+               (datetime.date(2011, 3, 4), datetime.date(2011, 3, 10)),
+               all_day([datetime.date(2011, 3, 5)]))
+
+    test_count(For(Daily(datetime.date(2011, 3, 1), 2), 3),
+               (datetime.date(2011, 3, 4), datetime.date(2011, 3, 10)))
+
+    ## test next and previous occurrences
+
+    noon = datetime.datetime(2011, 3, 2, 12, 00)
+
+    assert (Weekly(2).nextOccurrence(noon).date ==
+            datetime.date(2011, 3, 9))
+
+    assert (Weekly(2).previousOccurrence(noon).date ==
+            datetime.date(2011, 3, 2))
+
+    assert (Period(Weekly(2), datetime.time(17, 00), datetime.time(18, 00))
+            .nextOccurrence(noon).start == datetime.datetime(2011, 3, 2, 17, 00))
+
+    assert (Offset(Monthly(None, 1), datetime.timedelta(days=-1))
+            .nextOccurrence(noon).date == datetime.date(2011, 3, 31))
+
+    assert (Until(NthWeekday(-1, None, 4), datetime.date(2011, 3, 1))
+            .previousOccurrence(noon).date == datetime.date(2011, 2, 25))
+
+    assert (Except(Daily(datetime.date(2011, 3, 1), 1), Weekly(2, 3, 4))
+            .nextOccurrence(noon).date == datetime.date(2011, 3, 5))
+
+    assert Except(Weekly(2), Weekly(2)).nextOccurrence(noon) is None
+    assert Monthly(2, 30).previousOccurrence(noon) is None
+    assert DateSet(datetime.date(2011, 3, 1)).nextOccurrence(noon) is None
   
     ## test addition operator
 
@@ -705,5 +2306,187 @@ if __name__ == '__main__':
     assert (NthWeekday(2, None, 2).toEnglish() ==
             "every 2nd wednesday")
 
+    assert (Monthly(10, 25).toEnglish() == "25 of each october")
+
+    assert (NthWeekday(-1, None, 2).toEnglish() ==
+            "every last wednesday")
+
+    assert (NthWeekday(-2, 3, 0).toEnglish() ==
+            "every 2nd to last monday of march")
+
     assert (For(NthWeekday(2, None, 2), 100).toEnglish() ==
             "(every 2nd wednesday) repeating 100 times")
+
+    d = datetime.date
+    assert DateSet(d(2011, 3, 4), d(2011, 3, 1)).bounds() == \
+        (d(2011, 3, 1), d(2011, 3, 4))
+    assert Daily(d(2011, 3, 2), 3).bounds() == (d(2011, 3, 2), d.max)
+    assert Weekly(1).bounds() == (d.min, d.max)
+    assert Until(From(Weekly(1), d(2011, 1, 1)), d(2011, 2, 1)).bounds() == \
+        (d(2011, 1, 1), d(2011, 2, 1))
+    assert Offset(DateSet(d(2011, 3, 2)),
+                  datetime.timedelta(hours=-2)).bounds() == \
+        (d(2011, 3, 1), d(2011, 3, 2))
+    assert And(DateSet(d(2011, 3, 2)), Daily(d(2012, 1, 1), 2)).bounds() == \
+        (d(2011, 3, 2), d.max)
+    assert For(Daily(d(2011, 3, 2), 2), 3).bounds() == \
+        (d(2011, 3, 2), d(2011, 3, 6))
+    assert For(From(Weekly(2), d(2011, 3, 1)), 3).bounds() == \
+        (d(2011, 3, 2), d(2011, 3, 16))
+    assert For(Until(Daily(d(2011, 3, 2), 2), d(2011, 3, 5)), 3).bounds() == \
+        (d(2011, 3, 2), d(2011, 3, 5))
+    earliest, latest = DateSet().bounds()
+    assert earliest > latest
+
+    def test_simplify(recurrence, daterange, expected):
+        def times(r):
+            return set(o.key for o in r.timedOccurrences(*daterange))
+        value = recurrence.simplify()
+        if not (value == expected and times(value) == times(recurrence)):
+            print "failure: ", str(recurrence)
+            print "exp: ", str(expected)
+            print "got: ", str(value)
+
+    year = (d(2011, 1, 1), d(2011, 12, 31))
+    test_simplify(Offset(Offset(Monthly(None, 5), datetime.timedelta(hours=3)),
+                         datetime.timedelta(hours=-3)),
+                  year, Monthly(None, 5))
+    test_simplify(Offset(Offset(NthWeekday(1, None, 0), datetime.timedelta(1)),
+                         datetime.timedelta(hours=2)),
+                  year, Offset(NthWeekday(1, None, 0),
+                               datetime.timedelta(days=1, hours=2)))
+    test_simplify(Offset(Weekly(5, 6), datetime.timedelta(2)), year,
+                  Weekly(0, 1))
+    test_simplify(And(Weekly(1), And(Weekly(3), Weekly(1))), year,
+                  Weekly(1, 3))
+    test_simplify(And(DateSet(d(2011, 3, 2), d(2011, 3, 4)),
+                      DateSet(d(2011, 3, 4))),
+                  year, DateSet(d(2011, 3, 2), d(2011, 3, 4)))
+    test_simplify(And(Period(Weekly(1), datetime.time(9), datetime.time(10)),
+                      Period(Weekly(4), datetime.time(9), datetime.time(10))),
+                  year, Period(Weekly(1, 4), datetime.time(9),
+                               datetime.time(10)))
+    test_simplify(Until(From(Daily(d(2011, 3, 2), 3), d(2011, 3, 4)),
+                        d(2011, 6, 1)),
+                  year, Until(Daily(d(2011, 3, 5), 3), d(2011, 6, 1)))
+    test_simplify(From(Until(Weekly(2), d(2011, 6, 1)), d(2011, 3, 1)),
+                  year, Until(From(Weekly(2), d(2011, 3, 1)), d(2011, 6, 1)))
+    test_simplify(Until(Daily(d(2011, 3, 2), 1), d(2011, 3, 1)), year,
+                  DateSet())
+    test_simplify(Except(DateSet(d(2011, 3, 2), d(2011, 3, 3)), Weekly(2)),
+                  year, DateSet(d(2011, 3, 3)))
+    test_simplify(Except(Except(Weekly(2), DateSet(d(2011, 3, 2))),
+                         DateSet(d(2011, 3, 9))),
+                  year, Except(Weekly(2), DateSet(d(2011, 3, 2), d(2011, 3, 9))))
+
+    assert (Offset(Offset(Weekly(1), datetime.timedelta(hours=1)),
+                   datetime.timedelta(hours=1)) ==
+            Offset(Weekly(1), datetime.timedelta(hours=2)))
+
+    assert Weekly(3, 1) is Weekly(1, 3)
+    assert DateSet(d(2011, 3, 4), d(2011, 3, 2)) is \
+        DateSet(d(2011, 3, 2), d(2011, 3, 4), d(2011, 3, 2))
+    assert (Period(Weekly(1), datetime.time(9), datetime.time(10)) is
+            Period(Weekly(1), datetime.time(9), datetime.time(10)))
+    assert Weekly(1) != Weekly(2)
+    period = Period(Weekly(1), datetime.time(9), datetime.time(10))
+    tree = Except(And(period, Offset(period, datetime.timedelta(hours=1))),
+                  DateSet(d(2011, 3, 1)))
+    moved = Period(Weekly(1), datetime.time(8), datetime.time(10))
+    assert (tree.replace(period, moved) is
+            Except(And(moved, Offset(moved, datetime.timedelta(hours=1))),
+                   DateSet(d(2011, 3, 1))))
+    assert tree.replace(moved, period) is tree
+
+    def test_tiled(recurrence, daterange, period):
+        def values(occurrences):
+            return [(o.key, o.ordinal) for o in occurrences]
+        expected = values(recurrence.timedOccurrences(*daterange))
+        value = values(recurrence.tiledOccurrences(*daterange))
+        if not (value == expected and recurrence.period() == period):
+            print "failure: ", str(recurrence)
+            print "period: ", recurrence.period()
+
+    years = (d(2010, 12, 20), d(2013, 2, 3))
+    test_tiled(Weekly(1, 4), years, 7)
+    test_tiled(Period(Daily(d(2011, 3, 2), 3), datetime.time(9),
+                      datetime.time(10)), years, 3)
+    test_tiled(And(Weekly(2), Daily(d(2011, 1, 1), 4)), years, 28)
+    test_tiled(Except(Until(Daily(d(2011, 5, 1), 2), d(2012, 8, 1)),
+                      Offset(Weekly(0), datetime.timedelta(hours=-3))),
+               years, 14)
+    test_tiled(Offset(And(Weekly(3), From(Weekly(5), d(2011, 4, 1))),
+                      datetime.timedelta(days=2, hours=5)), years, 7)
+    test_tiled(NthWeekday(-1, None, 4), years, 146097)
+    test_tiled(Except(Weekly(1), DateSet(d(2011, 3, 1))), years, None)
+
+    for date in (d(1, 1, 1), d(2011, 2, 28), d(2012, 2, 29), d(2100, 2, 28),
+                 d(2000, 2, 29), d.max):
+        block, i = calendarTable.lookup(date.toordinal())
+        assert ((block.year[i], block.month[i], block.day[i],
+                 block.weekday[i], block.days_in_month[i]) ==
+                (date.year, date.month, date.day, date.weekday(),
+                 daysInMonth(date.year, date.month)))
+        assert (calendarTable.monthFields(date.year, date.month) ==
+                (date.replace(day=1).weekday(),
+                 daysInMonth(date.year, date.month)))
+    assert NthWeekday(-1, 2, 1).occursOnDate(d(2012, 2, 28))
+    assert not NthWeekday(-1, 2, 1).occursOnDate(d(2012, 2, 21))
+    assert NthWeekday(-1, 2, 2).occursOnDate(d(2012, 2, 29))
+
+    def test_compiled(recurrence, daterange):
+        compiled = recurrence.compile()
+        assert recurrence.compile() is compiled
+        expected = [(o.key, o.ordinal)
+                    for o in recurrence.timedOccurrences(*daterange)]
+        value = [(o.key, o.ordinal) for o in compiled.expand(*daterange)]
+        ordinals = xrange(daterange[0].toordinal(), daterange[1].toordinal() + 1)
+        if compiled.test and not all(compiled.test(o) ==
+                                     recurrence.occursOnOrdinal(o)
+                                     for o in ordinals):
+            print "failure: ", str(recurrence), "(test)"
+        if not value == expected:
+            print "failure: ", str(recurrence), "(expand)"
+
+    test_compiled(Except(Until(From(Weekly(1, 3), d(2011, 2, 1)), d(2011, 9, 1)),
+                         And(NthWeekday(-1, None, 1), Monthly(None, 15))),
+                  year)
+    test_compiled(Period(And(Daily(d(2011, 3, 2), 3), DateSet(d(2011, 5, 5))),
+                         datetime.time(9), datetime.time(10)), year)
+    test_compiled(Except(Weekly(0, 2), Offset(Weekly(6), datetime.timedelta(1))),
+                  year)
+    assert Offset(Weekly(1), datetime.timedelta(1)).compile().test is None
+
+    hour = datetime.timedelta(hours=1)
+    test_range(Period(Weekly(2), datetime.time(17), hour),
+               (d(2011, 3, 1), d(2011, 3, 8)),
+               [(datetime.datetime(2011, 3, 2, 17), datetime.datetime(2011, 3, 2, 18))])
+    test_range(Period(Weekly(2), datetime.time(23, 30), hour),
+               (d(2011, 3, 1), d(2011, 3, 8)),
+               [(datetime.datetime(2011, 3, 2, 23, 30),
+                 datetime.datetime(2011, 3, 3, 0, 30))])
+    assert (Period(Weekly(2), datetime.time(17), hour) + datetime.timedelta(1) is
+            Period(Weekly(3), datetime.time(17), hour))
+    assert (Period(Weekly(2), datetime.time(17),
+                   datetime.timedelta(minutes=90)).toEnglish() ==
+            "(every wednesday) at 17:00 for 1 hours 30 minutes")
+    timed = Period(Weekly(2), datetime.time(17), hour)
+    assert timed.withStart(datetime.time(16, 30)) is \
+        Period(Weekly(2), datetime.time(16, 30), datetime.timedelta(minutes=90))
+    assert timed.withStart(datetime.time(19)) is \
+        Period(Weekly(2), datetime.time(18), datetime.timedelta(0))
+    assert timed.withEnd(datetime.time(17, 45)) is \
+        Period(Weekly(2), datetime.time(17), datetime.timedelta(minutes=45))
+    assert timed.withEnd(datetime.time(16)) is \
+        Period(Weekly(2), datetime.time(17), datetime.timedelta(0))
+    fixed = Period(Weekly(2), datetime.time(17), datetime.time(18))
+    assert fixed.withStart(datetime.time(19)) is \
+        Period(Weekly(2), datetime.time(18), datetime.time(18))
+    assert fixed.withEnd(datetime.time(18, 30)) is \
+        Period(Weekly(2), datetime.time(17), datetime.time(18, 30))
+    outer = Period(And(Period(Weekly(1), datetime.time(9), datetime.time(10)),
+                       Offset(Weekly(3), datetime.timedelta(hours=20))),
+                   datetime.time(13), datetime.time(14))
+    occurrences = list(outer.timedOccurrences(d(2011, 3, 7), d(2011, 3, 13)))
+    assert [(o.creator, o.date, o.start.hour) for o in occurrences] == \
+        [(outer, d(2011, 3, 8), 13), (outer, d(2011, 3, 10), 13)]
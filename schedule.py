@@ -20,18 +20,82 @@
 # Boston, MA 02111-1307, USA.
 
 import datetime
+import bisect
+import itertools
+import collections
+import contextlib
+import heapq
 import recurrence
 import parser
 
 def eventFromStartEnd(start, end, description):
     return Event(recurrence.fromDateTimes(start, end), description)
 
+one_day = datetime.timedelta(days=1)
+
 def null(*args):
     return
 
+event_ids = itertools.count(1)
+
+# the kinds of change a schedule reports
+ADDED = "added"
+DELETED = "deleted"
+DESCRIPTION = "description"
+RECURRENCE = "recurrence"
+
+Change = collections.namedtuple("Change", "kind event_id")
+
+class ChangeBus(object):
+
+    # Delivers lists of Change records to any number of listeners.
+    # If idle is set to a function like gobject.idle_add, changes are
+    # queued and delivered together once the main loop is idle, with
+    # repeated records merged; otherwise each is delivered at once.
+
+    def __init__(self):
+        self.listeners = []
+        self.pending = []
+        self.idle = None
+
+    def connect(self, callback, *args):
+        self.listeners.append((callback, args))
+        return len(self.listeners) - 1
+
+    def disconnect(self, handle):
+        self.listeners[handle] = None
+
+    # queues changes to be delivered in a single list
+    def post(self, *changes):
+        if not changes:
+            return
+        queued = bool(self.pending)
+        self.pending.extend(changes)
+        if self.idle is None:
+            self.flush()
+        elif not queued:
+            self.idle(self.flush)
+
+    def flush(self):
+        changes = []
+        seen = set()
+        for change in self.pending:
+            if change not in seen:
+                seen.add(change)
+                changes.append(change)
+        self.pending = []
+        if changes:
+            for listener in self.listeners:
+                if listener:
+                    callback, args = listener
+                    callback(changes, *args)
+        # so that idle_add doesn't call us again
+        return False
+
 class Event(object):
 
     def __init__(self, recurrence, description):
+        self.id = event_ids.next()
         self.callback = null
         self.args = ()
         self._recurrence = None
@@ -45,8 +109,7 @@ class Event(object):
     def set_description(self, value):
         if value != self.description:
             self._description = value
-            # FIXME: make callback more generic
-            self.notify()
+            self.notify(DESCRIPTION)
  
     description = property(get_description, set_description)
 
@@ -54,9 +117,10 @@ class Event(object):
         return self._recurrence
 
     def set_recurrence(self, value):
-        # don't compare for equality, as this might be expensive
-        self._recurrence = value
-        self.notify()
+        # recurrences are interned, so this is an identity test
+        if value != self._recurrence:
+            self._recurrence = value
+            self.notify(RECURRENCE)
 
     recurrence = property(get_recurrence, set_recurrence)
 
@@ -67,34 +131,402 @@ class Event(object):
     def timedOccurences(self, start, end):
         return self.recurrence.timedOccurrences(start, end)
 
-    def notify(self):
-        self.callback(self, *self.args)
+    def notify(self, kind):
+        self.callback(self, kind, *self.args)
 
 class FixedEvent(Event):
 
     pass
-    
+
+class SpanIndex(object):
+
+    # Keeps events sorted by the first and last dates on which their
+    # recurrences can occur, so that a query only visits events whose
+    # span overlaps the window. Results come back in insertion order.
+
+    def __init__(self):
+        self.spans = {}
+        self.by_earliest = []
+        self.by_latest = []
+        self.keys = itertools.count()
+
+    def __len__(self):
+        return len(self.spans)
+
+    def add(self, event, key=None):
+        if key is None:
+            key = self.keys.next()
+        earliest, latest = event.recurrence.bounds()
+        self.spans[event] = (key, earliest, latest, event.recurrence)
+        bisect.insort(self.by_earliest, (earliest, key, event))
+        bisect.insort(self.by_latest, (latest, key, event))
+
+    # adds many events at once, sorting once rather than per event
+    def extend(self, events):
+        for event in events:
+            key = self.keys.next()
+            earliest, latest = event.recurrence.bounds()
+            self.spans[event] = (key, earliest, latest, event.recurrence)
+            self.by_earliest.append((earliest, key, event))
+            self.by_latest.append((latest, key, event))
+        self.by_earliest.sort()
+        self.by_latest.sort()
+
+    def remove(self, event):
+        key, earliest, latest, recurrence = self.spans.pop(event)
+        for entries, entry in ((self.by_earliest, (earliest, key, event)),
+                               (self.by_latest, (latest, key, event))):
+            del entries[bisect.bisect_left(entries, entry)]
+
+    # re-reads the span of an event whose recurrence has changed, and
+    # returns the recurrence the old span was read from
+    def update(self, event):
+        key, earliest, latest, recurrence = self.spans[event]
+        self.remove(event)
+        self.add(event, key)
+        return recurrence
+
+    # only the smaller of the two candidate runs gets copied
+    def query(self, start, end):
+        i = bisect.bisect_right(self.by_earliest, (end, float('inf')))
+        j = bisect.bisect_left(self.by_latest, (start,))
+        if i <= len(self.by_latest) - j:
+            found = [(key, event) for earliest, key, event
+                     in self.by_earliest[:i]
+                     if self.spans[event][2] >= start]
+        else:
+            found = [(key, event) for latest, key, event
+                     in self.by_latest[j:]
+                     if self.spans[event][1] <= end]
+        found.sort()
+        return [event for key, event in found]
+
+class OccurrenceIndex(object):
+
+    # The occurrences of every event in a schedule, materialized over
+    # a horizon of up to days days and kept sorted by start time, so
+    # that window and point queries cost a binary search plus the
+    # number of results. The horizon starts out as the first window
+    # asked for and grows to take in later ones, so only the days
+    # queried get expanded. Point queries look back lead days for
+    # occurrences still in progress. Each entry is a (start, sequence,
+    # end, event, occurrence) tuple, with start and end in minutes
+    # since 1/1/0001.
+
+    def __init__(self, schedule, days=180, lead=30):
+        self.schedule = schedule
+        self.days = days
+        self.lead = lead
+        self.start = None
+        self.end = None
+        self.entries = []
+        self.by_event = {}
+        self.longest = 0
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fits(self, start, end):
+        return (end - start).days < self.days - self.lead
+
+    def covers(self, start, end):
+        return (self.start is not None and
+                self.start <= start and end <= self.end)
+
+    def expand(self, event, start, end):
+        entries = []
+        for occurrence in event.recurrence.tiledOccurrences(start, end):
+            first, last = occurrence.key
+            self.longest = max(self.longest, last - first)
+            entries.append((first, self.sequence.next(), last, event,
+                            occurrence))
+        return entries
+
+    def expandAll(self, start, end):
+        entries = []
+        for event in self.schedule.index.query(start, end):
+            new = self.expand(event, start, end)
+            self.by_event.setdefault(event, set()).update(new)
+            entries.extend(new)
+        entries.sort()
+        return entries
+
+    def add(self, event):
+        if self.start is None:
+            return
+        entries = self.expand(event, self.start, self.end)
+        self.by_event[event] = set(entries)
+        for entry in entries:
+            bisect.insort(self.entries, entry)
+
+    def remove(self, event):
+        for entry in self.by_event.pop(event, ()):
+            del self.entries[bisect.bisect_left(self.entries, entry)]
+
+    def update(self, event):
+        self.remove(event)
+        self.add(event)
+
+    def drop(self, entries):
+        for entry in entries:
+            self.by_event[entry[3]].discard(entry)
+
+    # moves the horizon so that it covers the given window. If the
+    # window touches the old horizon, as much of that is kept as fits
+    # and only the days which weren't covered before are expanded.
+    def roll(self, start, end):
+        first = start.toordinal()
+        last = end.toordinal()
+        if (self.start is not None and first <= self.end.toordinal() + 1 and
+            last >= self.start.toordinal() - 1):
+            first, last = (
+                max(min(first, self.start.toordinal()), last - self.days + 1),
+                min(max(last, self.end.toordinal()), first + self.days - 1))
+        start = datetime.date.fromordinal(first)
+        end = datetime.date.fromordinal(last)
+        if self.start is None or start > self.end or end < self.start:
+            self.by_event = {}
+            self.entries = self.expandAll(start, end)
+        else:
+            i = bisect.bisect_left(self.entries, (first * 1440,))
+            j = bisect.bisect_left(self.entries, ((last + 1) * 1440,))
+            self.drop(self.entries[:i])
+            self.drop(self.entries[j:])
+            before = []
+            after = []
+            if start < self.start:
+                before = self.expandAll(start, self.start - one_day)
+            if end > self.end:
+                after = self.expandAll(self.end + one_day, end)
+            self.entries = before + self.entries[i:j] + after
+        self.start = start
+        self.end = end
+
+    # returns (event, occurrence) pairs for the occurrences starting
+    # on the dates from start to end, in order of start time, up to
+    # limit of them if it is given
+    def window(self, start, end, limit=None):
+        if not self.covers(start, end):
+            self.roll(start, end)
+        i = bisect.bisect_left(self.entries, (start.toordinal() * 1440,))
+        j = bisect.bisect_left(self.entries, ((end.toordinal() + 1) * 1440,))
+        if limit is not None:
+            j = min(j, i + limit)
+        return [entry[3:] for entry in self.entries[i:j]]
+
+    # returns (event, occurrence) pairs for the occurrences in progress
+    # at the given datetime
+    def at(self, when):
+        date = when.date()
+        start = datetime.date.fromordinal(max(date.toordinal() - self.lead, 1))
+        if not self.covers(start, date):
+            self.roll(start, date)
+        minute = when.toordinal() * 1440 + when.hour * 60 + when.minute
+        i = bisect.bisect_left(self.entries, (minute - self.longest,))
+        j = bisect.bisect_right(self.entries, (minute, float('inf')))
+        return [entry[3:] for entry in self.entries[i:j]
+                if entry[2] > minute or entry[0] == minute]
+
+class ExpansionCursor(object):
+
+    # Remembers the last window a view asked for. Views redraw the same
+    # window many times between edits, and the list only has to be
+    # built again once the schedule's occurrences change.
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.last = None
+
+    # returns the same (event, occurrence) pairs as
+    # Schedule.timedOccurrences, as a list
+    def timedOccurrences(self, start, end):
+        key = (start, end, self.schedule.generation)
+        if self.last is None or self.last[0] != key:
+            self.last = (key, list(self.schedule.timedOccurrences(start, end)))
+        return self.last[1]
+
 class Schedule(object):
 
     def __init__(self, path):
         self.events = []
-        self.callback = None
-        self.args = None
+        self.index = SpanIndex()
+        self.occurrences = OccurrenceIndex(self)
+        self.changes = ChangeBus()
+        # bumped whenever the set of occurrences changes
+        self.generation = 0
+        # changes made inside batch(), or None outside of one
+        self.batched = None
 
     def add_event(self, event):
         self.events.append(event)
-        event.set_date_changed_cb(self._event_changed_cb, self.args)
+        event.set_date_changed_cb(self._event_changed_cb, ())
+        if self.batched is not None:
+            self.batched.append(Change(ADDED, event.id))
+            return
+        self.index.add(event)
+        self.occurrences.add(event)
+        self.generation += 1
+        self.changes.post(Change(ADDED, event.id))
 
     def del_event(self, event):
         self.events.remove(event)
-        if self.callback:
-            self.callback(*self.args)
-            
-    def timedOccurrences(self, start, end):
+        event.set_date_changed_cb(null, ())
+        if self.batched is not None:
+            self.batched.append(Change(DELETED, event.id))
+            return
+        self.index.remove(event)
+        self.occurrences.remove(event)
+        self.generation += 1
+        self.changes.post(Change(DELETED, event.id))
+
+    # groups edits to the schedule: indexing is put off until the
+    # block finishes, then done once for everything, and listeners get
+    # all the changes in one list. If the block raises, the events and
+    # their recurrences and descriptions are put back as they were and
+    # nothing is reported. Nested batches join the outermost one.
+    @contextlib.contextmanager
+    def batch(self):
+        if self.batched is not None:
+            yield self
+            return
+        events = list(self.events)
+        saved = [(event, event.recurrence, event.description)
+                 for event in events]
+        self.batched = []
+        try:
+            yield self
+        except:
+            self.batched = None
+            for event in set(self.events) - set(events):
+                event.set_date_changed_cb(null, ())
+            self.events = events
+            for event, recurrence, description in saved:
+                event._recurrence = recurrence
+                event._description = description
+                event.set_date_changed_cb(self._event_changed_cb, ())
+            # drop anything a cursor saw during the block
+            self.generation += 1
+            raise
+        changes, self.batched = self.batched, None
+        self.reindex()
+        self.changes.post(*changes)
+
+    # rebuilds the span index, and updates the occurrence index for
+    # the events whose recurrences the old span index doesn't match
+    def reindex(self):
+        spans = self.index.spans
+        current = set(self.events)
+        for event in spans:
+            if event not in current:
+                self.occurrences.remove(event)
         for event in self.events:
-            for inst in event.timedOccurences(start, end):
+            if event not in spans or spans[event][3] is not event.recurrence:
+                self.occurrences.update(event)
+        self.index = SpanIndex()
+        self.index.extend(self.events)
+        self.generation += 1
+
+    # returns a cursor whose timedOccurrences() is cheap to call again
+    # with the same window
+    def cursor(self):
+        return ExpansionCursor(self)
+
+    # returns an iterator over (event, occurrence) pairs. Windows short
+    # enough to fit in the occurrence index come back in order of start
+    # time; longer ones are expanded event by event, unless ordered is
+    # set. At most limit pairs are returned if it is given.
+    def timedOccurrences(self, start, end, ordered=False, limit=None):
+        if self.occurrences.fits(start, end):
+            return iter(self.occurrences.window(start, end, limit))
+        if ordered:
+            pairs = self.mergedOccurrences(start, end)
+        else:
+            pairs = self.eventOccurrences(start, end)
+        return itertools.islice(pairs, limit)
+
+    def eventOccurrences(self, start, end):
+        for event in self.index.query(start, end):
+            for inst in event.recurrence.tiledOccurrences(start, end):
                 yield event, inst
 
+    # merges each event's occurrences lazily, so taking the first few
+    # only expands as far as each event's next occurrence
+    def mergedOccurrences(self, start, end):
+        def tagged(index, event):
+            occurrences = event.recurrence.compile().expand(start, end)
+            for count, occurrence in enumerate(occurrences):
+                yield occurrence.key[0], index, count, event, occurrence
+
+        streams = [tagged(i, event)
+                   for i, event in enumerate(self.index.query(start, end))]
+        for key in heapq.merge(*streams):
+            yield key[-2:]
+
+    # returns a list of up to count (event, occurrence) pairs, in order
+    # of start time, starting at the datetime after, and a token to
+    # pass back in place of after for the next page. The token holds
+    # where each event left off, so later pages don't expand any dates
+    # again. An empty page means there's nothing more. One of after
+    # and token must be given.
+    def agenda(self, count, after=None, token=None):
+        if token is None and after is None:
+            raise ValueError("agenda() needs either after or a token")
+        if token is None:
+            minute = (after.toordinal() * 1440 + after.hour * 60 +
+                      after.minute)
+            token = (minute, ())
+        minute, positions = token
+        positions = dict(positions)
+        if count <= 0:
+            return [], token
+
+        # positions are the start minute an event left off at, and how
+        # many of its occurrences starting then were already returned.
+        # Like nextDate, we give up looking after the search horizon.
+        def resumed(index, event):
+            first, skip = positions[event.id]
+            date = datetime.date.fromordinal(first / 1440)
+            latest = min(event.recurrence.bounds()[1], recurrence.clampedDate(
+                first / 1440 + recurrence.search_horizon))
+            if date > latest:
+                return
+            occurrences = event.recurrence.compile().expand(date, latest)
+            for n, occurrence in enumerate(occurrences):
+                start = occurrence.key[0]
+                if start < first:
+                    continue
+                if start == first and skip:
+                    skip -= 1
+                    continue
+                yield start, index, n, occurrence, event
+
+        earliest = min([minute] + [p[0] for p in positions.values()])
+        events = self.index.query(
+            datetime.date.fromordinal(earliest / 1440), datetime.date.max)
+        for event in events:
+            positions.setdefault(event.id, (minute, 0))
+        streams = [resumed(i, event) for i, event in enumerate(events)]
+        page = []
+        for start, index, n, occurrence, event in heapq.merge(*streams):
+            page.append((event, occurrence))
+            first, skip = positions[event.id]
+            positions[event.id] = (start, skip + 1 if start == first else 1)
+            minute = start
+            if len(page) == count:
+                break
+        # nothing else starts before the end of the page, so events
+        # which weren't on it can pick up from there
+        for event_id, (first, skip) in positions.items():
+            if first < minute:
+                positions[event_id] = (minute, 0)
+        return page, (minute, tuple(sorted(positions.items())))
+
+    # returns (event, occurrence) pairs for everything in progress at
+    # the given datetime
+    def occurrencesAt(self, when):
+        return self.occurrences.at(when)
+
     dateformat = "%m/%d/%Y:%H:%M:%S"
 
     def _datetime_from_string(self, string):
@@ -103,6 +535,9 @@ class Schedule(object):
     def load(self, path):
         try:
             data = open(path, "r").readlines()
+        except IOError:
+            return
+        with self.batch():
             for lineno, line in enumerate(data):
                 recurrence, description = line.split("|")
                 try:
@@ -111,8 +546,6 @@ class Schedule(object):
                     print "Error parsing file '%s' on line %d:" % (path, lineno)
                     print line.strip()
                     print (' ' * (e.position - 1)) + '^'
-        except IOError:
-            pass
 
     def save(self, path):
         dest = open(path, "w")
@@ -146,15 +579,253 @@ class Schedule(object):
             return None if line >= len(data) else line
 
         data = open(path, "r").readlines()
-        line = parseStanza(data, 0)
-        while line:
-            line = parseStanza(data, line + 1)
+        with self.batch():
+            line = parseStanza(data, 0)
+            while line:
+                line = parseStanza(data, line + 1)
 
-    def set_changed_cb(self, callback, *args):
-        self.callback = callback
-        self.args = args
-        for event in self.events:
-            event.set_date_changed_cb(self._event_changed_cb, self.args)
+    def _event_changed_cb(self, event, kind):
+        if self.batched is not None:
+            self.batched.append(Change(kind, event.id))
+            return
+        if kind == RECURRENCE:
+            old = self.index.update(event)
+            if old is not event.recurrence:
+                self.occurrences.update(event)
+                self.generation += 1
+        self.changes.post(Change(kind, event.id))
+
+if __name__ == '__main__':
+
+    d = datetime.date
+    t = datetime.time
+
+    def check(name, value, expected):
+        if value != expected:
+            print "failure: ", name
+            print "exp: ", expected
+            print "got: ", value
+
+    def daily(hour):
+        return recurrence.Period(recurrence.Daily(d(2026, 1, 1), 1),
+                                 t(hour), t(hour + 1))
+
+    ## test paging through the agenda
+
+    def pages(s, sizes, after, total):
+        got = []
+        page, token = s.agenda(sizes[0], after=after)
+        i = 1
+        while page and len(got) < total:
+            got.extend((o.key[0], e.id) for e, o in page)
+            page, token = s.agenda(sizes[i % len(sizes)], token=token)
+            i += 1
+        return got[:total]
+
+    def expanded(s, after, until):
+        minute = after.toordinal() * 1440 + after.hour * 60 + after.minute
+        return sorted((o.key[0], e.id) for e in s.events
+                      for o in e.recurrence.timedOccurrences(after.date(), until)
+                      if o.key[0] >= minute)
+
+    s = Schedule(None)
+    # two events starting at the same times, so pages end on ties
+    a = Event(recurrence.Until(daily(9), d(2026, 3, 1)), "a")
+    b = Event(recurrence.Until(daily(9), d(2026, 3, 1)), "b")
+    yearly = Event(recurrence.Monthly(12, 25), "yearly")
+    s.add_event(a)
+    s.add_event(b)
+    s.add_event(yearly)
+    after = datetime.datetime(2026, 1, 1, 9, 0)
+    expected = expanded(s, after, d(2026, 12, 31))
+    for sizes in ([1], [3], [2, 5, 1], [7]):
+        check("agenda %s" % sizes, pages(s, sizes, after, len(expected)),
+              expected)
+
+    try:
+        s.agenda(5)
+        print "failure: agenda without after or token"
+    except ValueError:
+        pass
+
+    # events which aren't on a page don't go back to where they began
+    page, token = s.agenda(10, after=after)
+    page, token = s.agenda(10, token=token)
+    minute, positions = token
+    check("agenda position", dict(positions)[yearly.id], (minute, 0))
+
+    # events added between pages only show up from the token on
+    page, token = s.agenda(5, after=after)
+    last = (page[-1][1].key[0], page[-1][0].id)
+    late = Event(daily(8), "late")
+    s.add_event(late)
+    got = []
+    while len(got) < 40:
+        page, token = s.agenda(4, token=token)
+        got.extend((o.key[0], e.id) for e, o in page)
+    expected = [x for x in expanded(s, after, d(2026, 1, 31)) if x > last]
+    check("agenda added", got, expected[:len(got)])
+
+    ## test the indexes against expanding every event
+
+    def brute(s, start, end):
+        return sorted((o.key, e.id) for e in s.events
+                      for o in e.recurrence.timedOccurrences(start, end))
+
+    def keyed(pairs):
+        return [(o.key, e.id) for e, o in pairs]
+
+    s = Schedule(None)
+    for r in (recurrence.DateSet(d(2011, 3, 2)),
+              recurrence.Daily(d(2011, 2, 1), 3),
+              recurrence.Until(recurrence.Weekly(2), d(2011, 4, 1)),
+              recurrence.NthWeekday(-1, None, 4),
+              recurrence.Offset(recurrence.Weekly(1),
+                                datetime.timedelta(hours=-5)),
+              recurrence.Period(recurrence.Weekly(0, 3), t(23),
+                                datetime.timedelta(minutes=90))):
+        s.add_event(Event(r, str(r)))
+
+    ## test the indexes
+
+    def spanned(s, start, end):
+        return [e.id for e in s.events
+                if e.recurrence.bounds()[0] <= end and
+                start <= e.recurrence.bounds()[1]]
+
+    # queries from either end of the index, in insertion order
+    for start, end in ((d(2011, 4, 2), d(2011, 4, 9)),
+                       (d(2011, 1, 1), d(2011, 1, 31)),
+                       (d(1, 1, 1), d(1, 1, 7)),
+                       (d(2011, 3, 2), d(2011, 3, 2))):
+        check("span index %s" % start,
+              [e.id for e in s.index.query(start, end)],
+              spanned(s, start, end))
+
+    cursor = s.cursor()
+    windows = [(d(2011, 3, 1), d(2011, 3, 7)), (d(2011, 3, 5), d(2011, 3, 12)),
+               (d(2011, 1, 20), d(2011, 3, 1)), (d(2012, 6, 1), d(2012, 6, 30))]
+    for start, end in windows:
+        expected = brute(s, start, end)
+        got = keyed(s.timedOccurrences(start, end))
+        check("window %s" % start, sorted(got), expected)
+        check("window order %s" % start, got, sorted(got))
+        check("cursor %s" % start,
+              sorted(keyed(cursor.timedOccurrences(start, end))), expected)
+        if start == d(2011, 3, 5):
+            # the horizon only grows by the days asked for
+            check("horizon", (s.occurrences.start, s.occurrences.end),
+                  (d(2011, 3, 1), d(2011, 3, 12)))
+    check("horizon jump", (s.occurrences.start, s.occurrences.end),
+          windows[-1])
+    when = datetime.datetime(2011, 3, 3, 0, 0)
+    check("at", sorted(keyed(s.occurrencesAt(when))),
+          sorted((o.key, e.id) for e in s.events
+                 for o in e.recurrence.timedOccurrences(d(2011, 3, 1),
+                                                        d(2011, 3, 3))
+                 if o.key[0] <= 1440 * when.toordinal() < o.key[1]))
+
+    ## test ordered and limited queries
+
+    # windows too long for the occurrence index
+    start, end = d(2011, 1, 1), d(2012, 6, 1)
+    full = keyed(s.timedOccurrences(start, end, ordered=True))
+    check("ordered", full, brute(s, start, end))
+    check("unordered", sorted(keyed(s.timedOccurrences(start, end))), full)
+    check("limit", keyed(s.timedOccurrences(start, end, ordered=True,
+                                            limit=20)), full[:20])
+    check("short limit",
+          keyed(s.timedOccurrences(d(2011, 3, 1), d(2011, 3, 20), limit=5)),
+          brute(s, d(2011, 3, 1), d(2011, 3, 20))[:5])
+    check("limit past the end",
+          len(list(s.timedOccurrences(d(2011, 3, 1), d(2011, 3, 2),
+                                      ordered=True, limit=1000))),
+          len(brute(s, d(2011, 3, 1), d(2011, 3, 2))))
+
+    # edits show up in the indexes
+    start, end = windows[0]
+    event = s.events[1]
+    event.recurrence = daily(9)
+    s.del_event(s.events[0])
+    check("edited", keyed(s.timedOccurrences(start, end)),
+          brute(s, start, end))
+    check("edited cursor",
+          sorted(keyed(cursor.timedOccurrences(start, end))),
+          brute(s, start, end))
+
+    ## test change notifications
+
+    changes = []
+    s.changes.connect(changes.append)
+
+    # description edits don't touch the occurrences
+    generation = s.generation
+    first = cursor.timedOccurrences(start, end)
+    event.description = "renamed"
+    check("description generation", s.generation, generation)
+    check("description cursor", cursor.timedOccurrences(start, end) is first,
+          True)
+    event.recurrence = daily(10)
+    check("recurrence generation", s.generation > generation, True)
+    check("recurrence changes", changes,
+          [[Change(DESCRIPTION, event.id)], [Change(RECURRENCE, event.id)]])
+
+    # with an idle function, changes are merged and delivered once
+    idle = []
+    changes[:] = []
+    s.changes.idle = idle.append
+    event.description = "again"
+    event.recurrence = daily(11)
+    event.recurrence = daily(12)
+    check("idle queued", (len(idle), changes), (1, []))
+    idle[0]()
+    check("idle delivered", changes,
+          [[Change(DESCRIPTION, event.id), Change(RECURRENCE, event.id)]])
+    s.changes.idle = None
+
+    # every connected listener hears about a change until disconnected
+    other = []
+    handle = s.changes.connect(lambda changes, tag: other.append(tag), "x")
+    changes[:] = []
+    event.description = "twice"
+    s.changes.disconnect(handle)
+    event.description = "once"
+    check("listeners", (len(changes), other), (2, ["x"]))
+
+    ## test batches
+
+    changes[:] = []
+    with s.batch():
+        added = [Event(daily(hour), str(hour)) for hour in (13, 14, 15)]
+        for new in added:
+            s.add_event(new)
+        with s.batch():
+            event.recurrence = daily(16)
+        s.del_event(added[0])
+    check("batch changes", changes,
+          [[Change(ADDED, new.id) for new in added] +
+           [Change(RECURRENCE, event.id), Change(DELETED, added[0].id)]])
+    check("batch index", keyed(s.timedOccurrences(start, end)),
+          brute(s, start, end))
+    # the occurrence index is updated rather than thrown away
+    check("batch horizon", s.occurrences.covers(start, end), True)
 
-    def _event_changed_cb(self, event):
-        self.callback(*self.args)
+    # a failed batch leaves the schedule as it was
+    changes[:] = []
+    before = (list(s.events), event.recurrence, event.description,
+              keyed(s.timedOccurrences(start, end)))
+    try:
+        with s.batch():
+            s.add_event(Event(daily(17), "17"))
+            event.recurrence = daily(18)
+            event.description = "failed"
+            s.del_event(added[1])
+            raise ValueError
+    except ValueError:
+        pass
+    check("rollback", (list(s.events), event.recurrence, event.description,
+                       keyed(s.timedOccurrences(start, end))), before)
+    check("rollback changes", changes, [])
+    added[1].description = "still connected"
+    check("rollback callbacks", changes,
+          [[Change(DESCRIPTION, added[1].id)]])
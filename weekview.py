@@ -152,7 +152,7 @@ class UntimedEvents(WeekViewBase):
 
     def sort_allday_events_by_date(self):
         events = {}
-        for event, period in self.info.model.timedOccurrences(*self.dates_visible()):
+        for event, period in self.expansion.timedOccurrences(*self.dates_visible()):
             if period.all_day:
                 date = period.date
                 if not date in events:
@@ -411,7 +411,7 @@ class TimedEvents(WeekViewBase):
         cr.rectangle(self.day_width, 0, self.width - self.day_width, self.height)
         cr.clip()
         self.occurrences = {}
-        for evt, period in self.model.timedOccurrences(*self.dates_visible()):
+        for evt, period in self.expansion.timedOccurrences(*self.dates_visible()):
             if period.all_day:
                 continue
             self.draw_event(cr, evt, period)
@@ -635,10 +635,10 @@ class MoveTimedEvent(MouseCommand):
         delta = self.instance.point_to_timedelta(int(x + self.offset), y, self.shift)
         if self.abs[1] < 0:
             delta = datetime.timedelta(delta.days)
-            self.event.recurrence = self.allday + delta
+            self.event.recurrence = (self.allday + delta).simplify()
         else:
 
-            self.event.recurrence = self.old + delta
+            self.event.recurrence = (self.old + delta).simplify()
         return True
 
     def undo(self):
@@ -657,20 +657,20 @@ class SetEventStart(MouseCommand):
         self.mdown = abs
         self.instance = instance
         self.selected = instance.selected
-        occurrence = instance.occurrences[self.selected][2]
-        self.recurrence = occurrence.creator
-        self.pos = self.recurrence.start
+        self.event, area, occurrence = instance.occurrences[self.selected]
+        self.period = occurrence.creator
+        self.old = self.event.recurrence
 
     def do(self):
-        self.recurrence.start = min(
-            self.instance.point_to_datetime(self.mdown[0], self.abs[1],
-                self.shift).time(),
-            self.recurrence.end)
+        start = self.instance.point_to_datetime(self.mdown[0], self.abs[1],
+            self.shift).time()
+        self.event.recurrence = self.old.replace(self.period,
+            self.period.withStart(start))
         self.instance.queue_draw()
         return True
 
     def undo(self):
-        self.recurrence.start = self.pos
+        self.event.recurrence = self.old
         self.selected = self.selected
 
 class SetEventEnd(MouseCommand):
@@ -685,20 +685,20 @@ class SetEventEnd(MouseCommand):
         self.mdown = abs
         self.instance = instance
         self.selected = instance.selected
-        occurrence = instance.occurrences[self.selected][2]
-        self.recurrence = occurrence.creator
-        self.pos = self.recurrence.end
+        self.event, area, occurrence = instance.occurrences[self.selected]
+        self.period = occurrence.creator
+        self.old = self.event.recurrence
 
     def do(self):
-        self.recurrence.end = max(
-            self.instance.point_to_datetime(self.mdown[0], self.abs[1],
-                self.shift).time(),
-            self.recurrence.start)
+        end = self.instance.point_to_datetime(self.mdown[0], self.abs[1],
+            self.shift).time()
+        self.event.recurrence = self.old.replace(self.period,
+            self.period.withEnd(end))
         self.instance.queue_draw()
         return True
 
     def undo(self):
-        self.recurrence.end = self.pos
+        self.event.recurrence = self.old
 
 class DragCalendarHorizontal(MouseCommand):
 